@@ -0,0 +1,83 @@
+"""Start-up time of statusdb: imports and connection set-up
+
+    python benchmarks/startup.py [--repeat N] [--top N] [--connect DB] [--config FILE]
+
+Every run is a fresh interpreter, so nothing is already imported or
+cached. Prints the median time to import statusdb.db.connections and the
+slowest modules it imports (python -X importtime). With --connect, also
+the median time to set up a connection to database DB, including loading
+the configuration, and to then load its name view.
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+CONNECTIONS = {"projects": "ProjectSummaryConnection",
+               "samples": "SampleRunMetricsConnection",
+               "flowcells": "FlowcellRunMetricsConnection"}
+
+# Run in the child interpreter, printing its timings as JSON
+_CHILD = """
+import json, sys, time
+start = time.time()
+from statusdb.db import connections
+times = {"import": time.time() - start}
+if len(sys.argv) > 1:
+    start = time.time()
+    con = getattr(connections, sys.argv[1])(conf=sys.argv[2] if len(sys.argv) > 2 else None)
+    times["connect"] = time.time() - start
+    start = time.time()
+    con.name_view
+    times["name_view"] = time.time() - start
+print(json.dumps(times))
+"""
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+
+
+def time_startup(repeat, connect=None, config=None):
+    """:returns: dictionary mapping step to its median time in seconds"""
+    args = [sys.executable, "-c", _CHILD]
+    if connect:
+        args.append(CONNECTIONS[connect])
+        if config:
+            args.append(config)
+    runs = [json.loads(subprocess.check_output(args).decode("utf-8")) for _ in range(repeat)]
+    return {step: _median([run[step] for run in runs]) for step in runs[0]}
+
+
+def slowest_imports(top):
+    """:returns: list of (cumulative seconds, module) of the slowest imports"""
+    err = subprocess.run([sys.executable, "-X", "importtime", "-c", "import statusdb.db.connections"],
+                         stderr=subprocess.PIPE, check=True).stderr.decode("utf-8")
+    imports = []
+    for line in err.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, module = line[len("import time:"):].split("|")
+        imports.append((int(cumulative) / 1e6, module.rstrip()))
+    return sorted(imports, reverse=True)[:top]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Start-up time of statusdb: imports and connection set-up")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--top", type=int, default=10, help="number of slowest imports to list")
+    parser.add_argument("--connect", choices=sorted(CONNECTIONS), help="also time connecting to this database")
+    parser.add_argument("--config", help="configuration file, by default ~/.ngi_config/statusdb.yaml")
+    args = parser.parse_args(argv)
+
+    for step, seconds in time_startup(args.repeat, args.connect, args.config).items():
+        print("{:12} {:>8.1f} ms".format(step, seconds * 1000))
+    print("\nSlowest imports, cumulative:")
+    for seconds, module in slowest_imports(args.top):
+        print("{:>8.1f} ms  {}".format(seconds * 1000, module))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Decode time and bytes on the wire of statusdb reads
+
+    python benchmarks/transfer.py [--config FILE] [--db DB] [--view VIEW] [--repeat N] NAME [NAME ...]
+
+With every JSON codec available, fetches the documents NAME with
+get_entry and loads the view attribute VIEW of the connection, printing
+per read the wall time, the time spent decoding JSON, and the bytes
+received on the wire and once decompressed. The etag cache of the
+session is cleared before every read so that full responses are sent.
+"""
+import argparse
+import time
+
+CONNECTIONS = {"projects": "ProjectSummaryConnection",
+               "samples": "SampleRunMetricsConnection",
+               "flowcells": "FlowcellRunMetricsConnection"}
+
+COLUMNS = ["requests", "decode_seconds", "bytes_received", "bytes_decoded"]
+
+
+def _codecs():
+    codecs = ["json"]
+    try:
+        import orjson
+    except ImportError:
+        pass
+    else:
+        codecs.append("orjson")
+    return codecs
+
+
+def measure(con, read, repeat):
+    """Run a read repeat times, after one untimed run.
+
+    :returns: mean wall time in seconds and mean TransferStats counts of a read
+    """
+    session = con.con.resource.session
+    read()
+    before = session.stats.snapshot()
+    wall = 0.0
+    for _ in range(repeat):
+        session.cache.by_url.clear()
+        start = time.time()
+        read()
+        wall += time.time() - start
+    after = session.stats.snapshot()
+    return wall / repeat, {k: (after[k] - before[k]) / float(repeat) for k in COLUMNS}
+
+
+def _load_view(con, view):
+    # Drop the view loaded by a previous access
+    con.__dict__.pop(view, None)
+    getattr(con, view)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Decode time and bytes on the wire of statusdb reads")
+    parser.add_argument("names", nargs="+", help="names of documents to get with get_entry")
+    parser.add_argument("--config", help="configuration file, by default ~/.ngi_config/statusdb.yaml")
+    parser.add_argument("--db", default="projects", choices=sorted(CONNECTIONS))
+    parser.add_argument("--view", default="name_view", help="view attribute of the connection to load")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    from statusdb.db import connections
+    cls = getattr(connections, CONNECTIONS[args.db])
+    print("{:8} {:20} {:>10} {:>9} {:>11} {:>14} {:>14}".format(
+        "codec", "read", "wall s", "requests", "decode s", "wire bytes", "decoded bytes"))
+    for codec in _codecs():
+        con = cls(conf=args.config, json_codec=codec, single_flight=False)
+        reads = [("get_entry x{}".format(len(args.names)), lambda: [con.get_entry(name) for name in args.names]),
+                 (args.view, lambda: _load_view(con, args.view))]
+        for label, read in reads:
+            wall, counts = measure(con, read, args.repeat)
+            print("{:8} {:20} {:>10.4f} {:>9.1f} {:>11.4f} {:>14.0f} {:>14.0f}".format(
+                codec, label, wall, counts["requests"], counts["decode_seconds"],
+                counts["bytes_received"], counts["bytes_decoded"]))
+
+
+if __name__ == "__main__":
+    main()
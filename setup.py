@@ -13,5 +13,8 @@ setup(name = "statusdb",
     description = ("Module for connecting to statusdb and retrieve "
                    "required information from available module within "),
     install_requires = install_requires,
-    packages = find_packages()
+    packages = find_packages(),
+    entry_points = {
+        "console_scripts": ["statusdb = statusdb.cli:main"],
+    }
     )
@@ -0,0 +1,140 @@
+"""Command line interface, installed as the statusdb console script
+
+    statusdb query [--db DB] [--method METHOD] [--jobs N] < requests.ndjson
+
+Each line of standard input is a JSON request, resolved through the
+connection methods, and answered with one JSON line on standard output,
+in order of completion:
+
+    {"id": 1, "db": "flowcells", "method": "get_phix_error_rate", "args": ["FC1", 1]}
+    {"id": 1, "result": 0.3}
+
+Lines that are not objects are keys, or lists of arguments, for the
+method and database given on the command line.
+"""
+import argparse
+import json
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from statusdb.tools.log import minimal_logger
+
+LOG = minimal_logger(__name__)
+
+# Read only methods callable through query, per database
+QUERY_METHODS = {
+    "projects": ["get_entry", "get_project_sample"],
+    "samples": ["get_entry", "get_project_sample"],
+    "flowcells": ["get_entry", "get_storage_status", "get_phix_error_rate"],
+}
+
+
+class _Connections(object):
+    """Connections shared by all workers, made on first use"""
+
+    def __init__(self, conf=None):
+        self.conf = conf
+        self._cons = {}
+        self._lock = threading.Lock()
+
+    def get(self, dbname):
+        with self._lock:
+            if dbname not in self._cons:
+                # Imported here since couchdb is slow to import
+                from statusdb.db import connections
+                cls = {"projects": connections.ProjectSummaryConnection,
+                       "samples": connections.SampleRunMetricsConnection,
+                       "flowcells": connections.FlowcellRunMetricsConnection}[dbname]
+                self._cons[dbname] = cls(conf=self.conf)
+            return self._cons[dbname]
+
+
+def _parse_request(line, lineno, db=None, method=None):
+    """Turn an input line into a request dictionary"""
+    value = json.loads(line)
+    if isinstance(value, dict):
+        request = dict(value)
+    else:
+        request = {"args": value if isinstance(value, list) else [value]}
+    request.setdefault("id", lineno)
+    request.setdefault("db", db)
+    request.setdefault("method", method)
+    return request
+
+
+def _resolve(cons, request):
+    dbname, method = request["db"], request["method"]
+    if method not in QUERY_METHODS.get(dbname, []):
+        raise ValueError("Unsupported method '{}' for database '{}'".format(method, dbname))
+    return getattr(cons.get(dbname), method)(*request.get("args", []), **request.get("kwargs", {}))
+
+
+def query(infile, outfile, conf=None, db=None, method=None, jobs=8):
+    """Resolve NDJSON requests from infile with up to jobs concurrent
+    lookups, writing NDJSON results to outfile as they complete.
+
+    :param infile: file with one JSON request per line
+    :param outfile: file to write one JSON result per line to
+    :param conf: configuration file, the default one if not given
+    :param db: database of requests not naming one
+    :param method: method of requests not naming one
+    :param jobs: number of concurrent lookups
+
+    :returns: number of failed requests
+    """
+    cons = _Connections(conf)
+    out_lock = threading.Lock()
+    failed = [0]
+
+    def write(result):
+        line = json.dumps(result, default=str)
+        with out_lock:
+            if "error" in result:
+                failed[0] += 1
+            outfile.write(line + "\n")
+            outfile.flush()
+
+    def run(request):
+        try:
+            write({"id": request["id"], "result": _resolve(cons, request)})
+        except Exception as e:
+            LOG.debug("Request %s failed: %r", request["id"], e)
+            write({"id": request["id"], "error": "{}: {}".format(type(e).__name__, e)})
+
+    pending = set()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for lineno, line in enumerate(infile, 1):
+            if not line.strip():
+                continue
+            try:
+                request = _parse_request(line, lineno, db, method)
+            except ValueError as e:
+                write({"id": lineno, "error": "Invalid request: {}".format(e)})
+                continue
+            # Bound the requests read ahead of the workers
+            if len(pending) >= 2 * jobs:
+                _, pending = wait(pending, return_when=FIRST_COMPLETED)
+            pending.add(executor.submit(run, request))
+    return failed[0]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="statusdb", description="Query statusdb")
+    subparsers = parser.add_subparsers(dest="command")
+    query_parser = subparsers.add_parser("query", help="resolve NDJSON requests read from standard input")
+    query_parser.add_argument("--config", help="configuration file, by default ~/.ngi_config/statusdb.yaml")
+    query_parser.add_argument("--db", choices=sorted(QUERY_METHODS), help="database of requests not naming one")
+    query_parser.add_argument("--method", help="method of requests not naming one, e.g. get_entry")
+    query_parser.add_argument("--jobs", "-j", type=int, default=8, help="number of concurrent lookups")
+    args = parser.parse_args(argv)
+    if args.command != "query":
+        parser.print_help()
+        return 2
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    failed = query(sys.stdin, sys.stdout, conf=args.config, db=args.db, method=args.method, jobs=args.jobs)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,9 +1,9 @@
 """Database module"""
+import copy
 import os
 import sys
-import couchdb
 from statusdb.tools.http import check_url
-from statusdb.tools.log import minimal_logger
+from statusdb.tools.log import minimal_logger, PER_DOCUMENT
 from statusdb.tools import config as statusdb_config
 try:
     import configparser
@@ -25,6 +25,51 @@ class ConnectionError(Exception):
     def __str__(self):
         return self.msg
 
+class lazy_view(object):
+    """Dictionary built from a couchdb view of the connection database,
+    loaded on first attribute access instead of at construction.
+
+    :param viewname: name of the view, as passed to couchdb.Database.view
+    :param row_value: which part of a row to map the key to; 'id', 'value' or 'row'
+    :param mirror_field: document field the view is keyed by, to look keys up in
+                         a local mirror instead; only for views mapping to 'id'
+    :param options: optional view query parameters
+    """
+
+    def __init__(self, viewname, row_value="value", mirror_field=None, **options):
+        self.viewname = viewname
+        self.row_value = row_value
+        self.mirror_field = mirror_field
+        self.options = options
+        self.name = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def _value(self, row):
+        return row if self.row_value == "row" else getattr(row, self.row_value)
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        view = {row.key: self._value(row) for row in obj.db.view(self.viewname, **self.options)}
+        # Cache on the instance, shadowing the descriptor from now on
+        obj.__dict__[self.name] = view
+        return view
+
+    def lookup_many(self, obj, keys):
+        """Query the view for some keys only, without loading it. Keys
+        with several rows map to the last one, as in the loaded view.
+
+        :returns: dictionary mapping key to value, or None if not in the view
+        """
+        values = {key: None for key in keys}
+        if not values:
+            return values
+        for row in obj.db.view(self.viewname, keys=list(values.keys()), **self.options):
+            values[row.key] = self._value(row)
+        return values
+
 class Database(object):
     """Main database connection object for noSQL databases"""
 
@@ -47,7 +92,7 @@ class Couch(Database):
     _doc_type = None
     _update_fn = None
 
-    def __init__(self, log=None, url=None,conf=None, **kwargs):
+    def __init__(self, log=None, url=None,conf=None, mirror=None, **kwargs):
 
         # Load from config if we have one
         config = statusdb_config.load_config(conf)
@@ -74,12 +119,22 @@ class Couch(Database):
             self.db = kwargs['db']
         if 'url' in kwargs:
             self.url = kwargs['url']
+        # JSON codec, see statusdb.db.session.use_json_codec
+        self.json_codec = kwargs.get('json_codec', 'auto')
+        # Gzip large request bodies, responses are always negotiated
+        self.compress_requests = kwargs.get('compress_requests', False)
+        # Timeouts, retries, hedging and circuit breaking, see statusdb.db.policy
+        self.policy = kwargs.get('policy')
+        # Share concurrent identical reads, see statusdb.db.singleflight
+        self.single_flight = kwargs.get('single_flight', True)
 
         # Connect to the database
         self.url_string = "https://{}:{}@{}".format(self.user, self.pw, self.url)
         self.display_url_string = "https://{}:{}@{}".format(self.user, "*********", self.url)
         if log:
             self.log = log
+        # Local read-only mirror to read documents from, if any
+        self.mirror = mirror
         super(Couch, self).__init__(**kwargs)
         if not self.con:
             raise ConnectionError("Connection failed for url {}".format(self.display_url_string))
@@ -88,7 +143,14 @@ class Couch(Database):
         if not check_url(self.url_string):
             self.log.warn("No such url {}".format(self.display_url_string))
             return None
-        self.con = couchdb.Server(url=self.url_string)
+        # Imported here since couchdb is slow to import
+        import couchdb
+        from statusdb.db.session import StatusdbSession, use_json_codec
+        use_json_codec(self.json_codec)
+        session = StatusdbSession(compress_requests=self.compress_requests, policy=self.policy,
+                                  single_flight=self.single_flight)
+        self.policy = session.policy
+        self.con = couchdb.Server(url=self.url_string, session=session)
         self.log.debug("Connected to server @{}".format(self.display_url_string))
 
     def set_db(self, dbname):
@@ -111,20 +173,128 @@ class Couch(Database):
         """
         if not self._doc_type:
             return
-        self.log.debug("retrieving field entry in field '{}' for name '{}'".format(field, name))
-        if use_id_view:
-            view = self.id_view
-        else:
-            view = self.name_view
-        if view.get(name, None) is None:
-            self.log.warn("no entry '{}' in {}".format(name, self.db))
+        self.log.debug("retrieving field entry in field '%s' for name '%s'", field, name, extra=PER_DOCUMENT)
+        doc_id = self._view_lookup("id_view" if use_id_view else "name_view", name)
+        if doc_id is None:
+            self.log.warn("no entry '%s' in %s", name, self.db, extra=PER_DOCUMENT)
             return None
-        doc = self._doc_type(**self.db.get(view.get(name)))
+        doc = self._doc_type(**self._get_doc(doc_id))
         if field:
             return doc[field]
         else:
             return doc
 
+    def get_entries(self, names, field=None, use_id_view=False):
+        """Retrieve entries from db for a list of names in a single
+        request, subset to field if that value is passed.
+
+        :param names: list of unique name identifiers (primary key, not the uuid)
+        :param field: get 'field' of documents, i.e. key in document dict
+        :param use_id_view: Boolean to mention which view to use (name or id)
+
+        :returns: dictionary mapping name to document, or None if not found
+        """
+        if not self._doc_type:
+            return
+        entries = {name: None for name in names}
+        ids = {}
+        for name, doc_id in self._view_lookup_many("id_view" if use_id_view else "name_view", list(entries)).items():
+            if doc_id is None:
+                self.log.warn("no entry '%s' in %s", name, self.db, extra=PER_DOCUMENT)
+            else:
+                ids[doc_id] = name
+        for docid, obj in self._get_docs(list(ids.keys())).items():
+            if obj is None:
+                continue
+            doc = self._doc_type(**obj)
+            entries[ids[docid]] = doc[field] if field else doc
+        return entries
+
+    def _view_lookup(self, view_name, key, use_mirror=True, use_loaded=True):
+        """Look up a key in a view attribute, querying the server for the
+        key only if the view has not been loaded.
+
+        :param view_name: name of the view attribute, e.g. 'name_view'
+        :param key: view key
+        :param use_mirror: False to never look the key up in the mirror
+        :param use_loaded: False to query the server even if the view has been loaded
+        """
+        return self._view_lookup_many(view_name, [key], use_mirror, use_loaded)[key]
+
+    def _view_lookup_many(self, view_name, keys, use_mirror=True, use_loaded=True):
+        """Look up keys in a view attribute, in one request if the view
+        has not been loaded. Views keyed by a document field are looked
+        up in the mirror first, if there is one.
+
+        :param view_name: name of the view attribute, e.g. 'name_view'
+        :param keys: list of view keys
+        :param use_mirror: False to never look keys up in the mirror
+        :param use_loaded: False to query the server even if the view has been
+                           loaded, e.g. before writing, since the loaded view
+                           misses documents created after it was
+
+        :returns: dictionary mapping key to value, or None if not in the view
+        """
+        view = getattr(type(self), view_name, None)
+        if isinstance(view, lazy_view) and (not use_loaded or view_name not in self.__dict__):
+            values = {key: None for key in keys}
+            if use_mirror and self.mirror is not None and view.mirror_field:
+                values.update(self.mirror.find_ids(self.db.name, view.mirror_field, list(values.keys())))
+            # Keys missing in the mirror may have been added since the last sync
+            missing = [key for key, value in values.items() if value is None]
+            if missing:
+                values.update(view.lookup_many(self, missing))
+            return values
+        view = getattr(self, view_name)
+        return {key: view.get(key, None) for key in keys}
+
+    def _get_doc(self, doc_id, use_mirror=True):
+        """Fetch a document, from the mirror if there is one and it has
+        the document, otherwise from the server.
+
+        :param doc_id: couchdb document id
+        :param use_mirror: False to always read from the server, e.g. when the
+                           revision is needed to write the document back
+        """
+        if use_mirror and self.mirror is not None:
+            doc = self.mirror.get(self.db.name, doc_id)
+            if doc is not None:
+                return doc
+        return self.db.get(doc_id)
+
+    def _get_docs(self, doc_ids, use_mirror=True):
+        """Fetch documents for a list of document ids, from the mirror if
+        there is one and through one _all_docs request for the rest.
+
+        :param doc_ids: list of couchdb document ids
+        :param use_mirror: False to always read from the server, e.g. when the
+                           revisions are needed to write the documents back
+
+        :returns: dictionary mapping document id to document, or None if missing
+        """
+        docs = {docid: None for docid in doc_ids}
+        if use_mirror and self.mirror is not None:
+            docs.update(self.mirror.get_many(self.db.name, list(docs.keys())))
+        missing = [docid for docid, doc in docs.items() if doc is None]
+        if not missing:
+            return docs
+        docs.update((row.key, row.get("doc")) for row in self.db.view("_all_docs", keys=missing, include_docs=True)
+                    if row.get("doc"))
+        return docs
+
+    def _get_revs(self, doc_ids):
+        """Get current revisions of documents in one request, without
+        the documents.
+
+        :param doc_ids: list of couchdb document ids
+
+        :returns: dictionary mapping document id to revision, for existing documents only
+        """
+        if not doc_ids:
+            return {}
+        return {row.key: row.value["rev"] for row in self.db.view("_all_docs", keys=list(doc_ids))
+                if row.get("value") and not row.value.get("deleted")}
+
     def save(self, obj, **kwargs):
         """Save/update database object <obj>. If <obj> already exists
         and <update_fn> is defined, update will only take place if
@@ -134,14 +304,101 @@ class Couch(Database):
         """
         if not self._update_fn:
             self.db.save(obj)
-            self.log.info("Saving object {} with id {}".format(repr(obj), obj["_id"]))
+            self.log.info("Saving object %r with id %s", obj, obj["_id"], extra=PER_DOCUMENT)
         else:
-            (new_obj, dbid) = self._update_fn(self.db, obj, **kwargs)
-            if not new_obj is None:
-                self.log.info("Saving object {} with id '{}'".format(repr(new_obj), new_obj["_id"]))
+            from statusdb.db.policy import retry_on_conflict
+
+            def attempt():
+                # update_fn merges the database document into the object it
+                # is given, so every attempt starts over from the caller's one
+                attempt_obj = copy.deepcopy(obj)
+                self._update(attempt_obj, **kwargs)
+                return attempt_obj
+            obj.update(retry_on_conflict(attempt, self.policy.conflict_retries))
+
+    def ensure_indexes(self):
+        """Create the Mango indexes declared for this database in
+        statusdb.db.design, if missing.
+
+        :returns: list of names of created indexes
+        """
+        from statusdb.db import design
+        return design.ensure_mango_indexes(self.db, self.db.name)
+
+    def find(self, selector, fields=None, limit=None, sort=None, bookmark=None, use_index=None):
+        """Query documents with a Mango selector.
+
+        :param selector: Mango selector, e.g. {"project_id": "P123"}
+        :param fields: list of fields to return, all if None
+        :param limit: maximum number of documents to return
+        :param sort: Mango sort specification
+        :param bookmark: bookmark from a previous call, to get the next page
+        :param use_index: index to use, e.g. ['statusdb_mango', 'project_id']
+
+        :returns: tuple of list of documents and bookmark for the next page
+        """
+        data = self._mango("_find", selector, fields, limit, sort, bookmark, use_index)
+        if data.get("warning"):
+            self.log.warn("Query %s on %s: %s", selector, self.db, data["warning"])
+        return data.get("docs", []), data.get("bookmark")
+
+    def find_all(self, selector, fields=None, sort=None, batch_size=1000, use_index=None):
+        """Iterate over all documents matching a Mango selector, fetching
+        them in pages of batch_size documents.
+
+        :param selector: Mango selector
+        :param fields: list of fields to return, all if None
+        :param sort: Mango sort specification
+        :param batch_size: number of documents per request
+        :param use_index: index to use
+        """
+        bookmark = None
+        while True:
+            docs, bookmark = self.find(selector, fields, batch_size, sort, bookmark, use_index)
+            for doc in docs:
+                yield doc
+            if len(docs) < batch_size:
+                return
+
+    def explain(self, selector, fields=None, limit=None, sort=None, use_index=None):
+        """Get the server's plan for a Mango query, to check which index it uses.
+
+        :returns: dictionary as returned by _explain, the index used under 'index'
+        """
+        return self._mango("_explain", selector, fields, limit, sort, None, use_index)
+
+    def _mango(self, endpoint, selector, fields, limit, sort, bookmark, use_index):
+        query = {"selector": selector}
+        for key, value in [("fields", fields), ("limit", limit), ("sort", sort),
+                           ("bookmark", bookmark), ("use_index", use_index)]:
+            if value is not None:
+                query[key] = value
+        _, _, data = self.db.resource.post_json(endpoint, body=query)
+        return data
+
+    def write_behind(self, **kwargs):
+        """Get a write-behind queue saving documents to the database in
+        batches from a background thread, see statusdb.db.writebehind.
+
+        Documents are matched to existing ones by name and merged
+        with them, as save does.
+
+        :param kwargs: passed to WriteBehindQueue
+        """
+        from statusdb.db.writebehind import WriteBehindQueue
+        return WriteBehindQueue(self.db, con=self, **kwargs)
+
+    def _update(self, obj, **kwargs):
+        from statusdb.db.utils import patch_couchdb_obj
+        (new_obj, dbid, dbobj) = self._update_fn(self.db, obj, **kwargs)
+        if not new_obj is None:
+            self.log.info("Saving object %r with id '%s'", new_obj, new_obj["_id"], extra=PER_DOCUMENT)
+            # Changes to an existing document are sent as a patch if possible;
+            # a conflicting patch is raised for save to retry from a fresh read
+            if dbobj is None or not patch_couchdb_obj(self.db, new_obj, dbobj):
                 self.db.save(new_obj)
-            else:
-                self.log.info("Object {} with id '{}' present and not in need of updating".format(repr(obj), dbid.id))
+        else:
+            self.log.info("Object %r with id '%s' present and not in need of updating", obj, dbid.id, extra=PER_DOCUMENT)
 
 
 class GenoLogics(Database):
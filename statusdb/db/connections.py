@@ -1,11 +1,15 @@
 """Database backend for connecting to statusdb"""
 import re
 import collections
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
 from uuid import uuid4
 from datetime import datetime
-from statusdb.db import Couch
-from statusdb.db.utils import save_couchdb_obj
-from statusdb.tools.log import minimal_logger
+from statusdb.db import Couch, lazy_view
+from statusdb.db import design
+from statusdb.tools.log import minimal_logger, PER_DOCUMENT
 from statusdb.tools.misc import query_yes_no, merge
 
 LOG = minimal_logger(__name__)
@@ -23,7 +27,7 @@ def utc_time():
 def _update(d, u, override=True):
     """Update values of a nested dictionary of varying depth"""
     for k, v in u.items():
-        if isinstance(v, collections.Mapping):
+        if isinstance(v, Mapping):
             r = _update(d.get(k, {}), v)
             d[k] = r
         else:
@@ -116,6 +120,24 @@ def _match_barcode_name_to_project_sample(barcode_name, project_samples, extensi
                 return {'sample_name':project_sample_name, 'project_sample':project_samples[project_sample_name]}
     return None
 
+def _equal_documents(a, b):
+    """Compare documents, ignoring ids, revisions and time stamps"""
+    a_keys = [str(x) for x in list(a.keys()) if x not in ["_id", "_rev", "creation_time", "modification_time"]]
+    b_keys = [str(x) for x in list(b.keys()) if x not in ["_id", "_rev", "creation_time", "modification_time"]]
+    keys = list(set(a_keys + b_keys))
+    return {k:a.get(k, None) for k in keys} == {k:b.get(k, None) for k in keys}
+
+def _merge_db_document(obj, dbobj, t_utc):
+    """Merge the newly created object with the one found in the database, replacing
+    the information found in the database for the new one if found the same key"""
+    merge(obj, dbobj)
+    # We need the original times and id from the DB object though
+    obj["creation_time"] = dbobj.get("creation_time")
+    obj["modification_time"] = t_utc
+    obj["_rev"] = dbobj.get("_rev")
+    obj["_id"] = dbobj.get("_id")
+    return obj
+
 # Updating function for object comparison
 def update_fn(cls, db, obj, viewname = "names/id_to_name", key="name"):
     """Compare object with object in db if present.
@@ -124,15 +146,10 @@ def update_fn(cls, db, obj, viewname = "names/id_to_name", key="name"):
     :param db: couch database
     :param obj: database object to save
 
-    :returns: database object to save and database id if present
+    :returns: database object to save, or None if unchanged, database id if
+              present and database document it was merged with, if any
     """
     t_utc = utc_time()
-    def equal(a, b):
-        a_keys = [str(x) for x in list(a.keys()) if x not in ["_id", "_rev", "creation_time", "modification_time"]]
-        b_keys = [str(x) for x in list(b.keys()) if x not in ["_id", "_rev", "creation_time", "modification_time"]]
-        keys = list(set(a_keys + b_keys))
-        return {k:a.get(k, None) for k in keys} == {k:b.get(k, None) for k in keys}
-
     view = db.view(viewname)
     d_view = {k.value:k for k in view}
     dbid =  d_view.get(obj[key], None)
@@ -142,19 +159,83 @@ def update_fn(cls, db, obj, viewname = "names/id_to_name", key="name"):
         dbobj = db.get(dbid.id, None)
     if dbobj is None:
         obj["creation_time"] = t_utc
-        return (obj, dbid)
-    if equal(obj, dbobj):
-        return (None, dbid)
+        return (obj, dbid, None)
+    if _equal_documents(obj, dbobj):
+        return (None, dbid, dbobj)
     else:
-        # Merge the newly created object with the one found in the database, replacing
-        # the information found in the database for the new one if found the same key
-        merge(obj, dbobj)
-        # We need the original times and id from the DB object though
-        obj["creation_time"] = dbobj.get("creation_time")
-        obj["modification_time"] = t_utc
-        obj["_rev"] = dbobj.get("_rev")
-        obj["_id"] = dbobj.get("_id")
-        return (obj, dbid)
+        return (_merge_db_document(obj, dbobj, t_utc), dbid, dbobj)
+
+def _barcode_lane_statistics(stats, project_id, sample_id, lane):
+    """Get Mean Quality Score (PF) and % of >= Q30 Bases (PF) from the
+    Barcode_lane_stat view value of a flowcell"""
+    stats_d = {"{}-{}-{}".format(item.get("Project", None).replace("__", "."),
+                                 item.get("Sample ID", None),
+                                 item.get("Lane", None)):item for item in stats}
+    sample_data = stats_d.get("{}-{}-{}".format(project_id, sample_id, lane), None)
+    if not sample_data:
+        return None, None
+    return sample_data.get('Mean Quality Score (PF)', None), sample_data.get('% of >= Q30 Bases (PF)', None)
+
+# Flowcell summary helpers, all working on an already fetched document
+FlowcellSummary = collections.namedtuple("FlowcellSummary",
+                                         ["name", "instrument", "run_mode", "paired_end", "phix_error_rate"])
+
+def _error_rate(value):
+    """Error rate as a float, -1 if missing or not a number"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return -1
+
+def _phix_error_rates(fc):
+    """Get phix error rate for all lanes of a flowcell document in one pass.
+
+    Error rates for non-index reads in the "old" Summary structure are
+    used if present, otherwise the LIMS-parsed run_summary structure.
+
+    :param fc: flowcell document
+
+    :returns: dictionary mapping lane to error rate, -1 if it could not be determined
+    """
+    illumina = fc.get("illumina", {})
+    summary_r = {}
+    for read in list(illumina.get("Summary", {}).values()):
+        if read.get("ReadType", "").strip() == "(Index)":
+            continue
+        for lane, data in read.items():
+            if not isinstance(data, dict):
+                continue
+            r = _error_rate(data.get("ErrRatePhiX"))
+            # Only use the value if error rate is >0.0
+            summary_r.setdefault(lane, [])
+            if r > 0:
+                summary_r[lane].append(r)
+    run_summary = illumina.get("run_summary", {})
+    lanes = set(summary_r.keys()) | set(k for k, v in run_summary.items() if isinstance(v, dict))
+    rates = {}
+    for lane in lanes:
+        phix_r = summary_r.get(lane)
+        if not phix_r:
+            phix_r = [r for r in (_error_rate(v) for k, v in run_summary.get(lane, {}).items()
+                                  if k.startswith("% Error Rate")) if r > 0]
+        rates[lane] = sum(phix_r)/len(phix_r) if phix_r else -1
+    return rates
+
+def _instrument(fc):
+    instrument = fc.get('RunInfo', {}).get('Instrument', None)
+    if not instrument:
+        instrument = fc.get('RunParameters', {}).get('Setup', {}).get('ScannerID', None)
+    return instrument
+
+def _run_mode(fc):
+    return fc.get('RunParameters', {}).get('Setup', {}).get('RunMode', None)
+
+def _is_paired_end(fc):
+    reads = fc.get('RunInfo', {}).get('Reads', [])
+    return len([read for read in reads if read.get('IsIndexedRead','N') == 'N']) == 2
+
+def _flowcell_summary(name, fc):
+    return FlowcellSummary(name, _instrument(fc), _run_mode(fc), _is_paired_end(fc), _phix_error_rates(fc))
 
 ##############################
 # Documents
@@ -246,18 +327,29 @@ class AnalysisDocument(StatusDocument):
 class SampleRunMetricsConnection(Couch):
     _doc_type = SampleRunMetricsDocument
     _update_fn = update_fn
+    name_view = lazy_view("names/name", "id", mirror_field="name", reduce=False)
+    name_fc_view = lazy_view("names/name_fc", "row", reduce=False)
+    name_proj_view = lazy_view("names/name_proj", "row", reduce=False)
+    name_fc_proj_view = lazy_view("names/name_fc_proj", "row", reduce=False)
     def __init__(self, dbname="samples", **kwargs):
         super(SampleRunMetricsConnection, self).__init__(**kwargs)
         self.db = self.con[dbname]
-        self.name_view = {k.key:k.id for k in self.db.view("names/name", reduce=False)}
-        self.name_fc_view = {k.key:k for k in self.db.view("names/name_fc", reduce=False)}
-        self.name_proj_view = {k.key:k for k in self.db.view("names/name_proj", reduce=False)}
-        self.name_fc_proj_view = {k.key:k for k in self.db.view("names/name_fc_proj", reduce=False)}
 
     def set_db(self, dbname):
         """Make sure we don't change db from samples"""
         pass
 
+    def ingest(self, records, **kwargs):
+        """Create or update many documents in bulk, see
+        statusdb.db.ingest.ingest_sample_run_metrics.
+
+        :param records: list of dictionaries of SampleRunMetricsDocument keyword arguments
+
+        :returns: IngestStats
+        """
+        from statusdb.db.ingest import ingest_sample_run_metrics
+        return ingest_sample_run_metrics(self, records, **kwargs)
+
     def get_sample_ids(self, fc_id=None, sample_prj=None):
         """Retrieve sample ids subset by fc_id and/or sample_prj
 
@@ -266,7 +358,7 @@ class SampleRunMetricsConnection(Couch):
 
         :returns sample_ids: list of couchdb sample ids
         """
-        self.log.debug("retrieving sample ids subset by flowcell '{}' and sample_prj '{}'".format(fc_id, sample_prj))
+        self.log.debug("retrieving sample ids subset by flowcell '%s' and sample_prj '%s'", fc_id, sample_prj)
         fc_sample_ids = [self.name_fc_view[k].id for k in list(self.name_fc_view.keys()) if self.name_fc_view[k].value == fc_id] if fc_id else []
         prj_sample_ids = [self.name_proj_view[k].id for k in list(self.name_proj_view.keys()) if self.name_proj_view[k].value == sample_prj] if sample_prj else []
         # | -> union, & -> intersection
@@ -283,7 +375,7 @@ class SampleRunMetricsConnection(Couch):
                 sample_ids = []
                 self.log.warn("No such project '{}' for flowcell '{}'".format(sample_prj, fc_id))
 
-        self.log.debug("Number of samples: {}, number of fc samples: {}, number of project samples: {}".format(len(sample_ids), len(fc_sample_ids), len(prj_sample_ids)))
+        self.log.debug("Number of samples: %d, number of fc samples: %d, number of project samples: %d", len(sample_ids), len(fc_sample_ids), len(prj_sample_ids))
         return sample_ids
 
     def get_samples(self, fc_id=None, sample_prj=None):
@@ -294,11 +386,10 @@ class SampleRunMetricsConnection(Couch):
 
         :returns samples: list of sample_run_metrics documents
         """
-        self.log.debug("retrieving samples subset by flowcell '{}' and sample_prj '{}'".format(fc_id, sample_prj))
+        self.log.debug("retrieving samples subset by flowcell '%s' and sample_prj '%s'", fc_id, sample_prj)
         sample_ids = self.get_sample_ids(fc_id, sample_prj)
-        inv_view = {v:k for k,v in self.name_view.items()}
-        sample_names = [inv_view[x] for x in sample_ids]
-        return [self.get_entry(x) for x in sample_names]
+        docs = self._get_docs(sample_ids)
+        return [self._doc_type(**docs[x]) if docs[x] else None for x in sample_ids]
 
     def get_project_sample(self, prj_sample_name, sample_prj=None, fc_id=None):
         """Retrieve all documents for a project sample based on the project_sample_name field,
@@ -316,13 +407,13 @@ class SampleRunMetricsConnection(Couch):
 class FlowcellRunMetricsConnection(Couch):
     _doc_type = FlowcellRunMetricsDocument
     _update_fn = update_fn
+    name_view = lazy_view("names/name", "id", mirror_field="name", reduce=False)
+    storage_status_view = lazy_view("info/storage_status")
+    id_view = lazy_view("info/id")
+    stat_view = lazy_view("names/Barcode_lane_stat", reduce=False)
     def __init__(self, dbname="flowcells", **kwargs):
         super(FlowcellRunMetricsConnection, self).__init__(**kwargs)
         self.db = self.con[dbname]
-        self.name_view = {k.key:k.id for k in self.db.view("names/name", reduce=False)}
-        self.storage_status_view = {k.key:k.value for k in self.db.view("info/storage_status")}
-        self.id_view = {k.key:k.value for k in self.db.view("info/id")}
-        self.stat_view = {k.key:k.value for k in self.db.view("names/Barcode_lane_stat", reduce=False)}
 
     def set_db(self):
         """Make sure we don't change db from flowcells"""
@@ -336,96 +427,154 @@ class FlowcellRunMetricsConnection(Couch):
         project names are formatted as J__Doe_00_01 in
         Demultiplex_stats.htm.
         """
-        if flowcell not in list(self.stat_view.keys()):
-            return None, None
-        stats = self.stat_view.get(flowcell)
-        stats_d = {"{}-{}-{}".format(item.get("Project", None).replace("__", "."),
-                                     item.get("Sample ID", None),
-                                     item.get("Lane", None)):item for item in stats}
-        sample_data = stats_d.get("{}-{}-{}".format(project_id, sample_id, lane), None)
-        if not sample_data:
+        stats = self._view_lookup("stat_view", flowcell)
+        if stats is None:
             return None, None
-        return sample_data.get('Mean Quality Score (PF)', None), sample_data.get('% of >= Q30 Bases (PF)', None)
+        return _barcode_lane_statistics(stats, project_id, sample_id, lane)
 
     def get_phix_error_rate(self, name, lane):
-        """Get phix error rate. Returns -1 if error rate could not be determined"""
-        fc = self.get_entry(name)
-        phix_r = []
-
-        # Get the error rate for non-index reads and add them
-        summary = fc.get("illumina",{}).get("Summary",{})
-        for read in list(summary.values()):
-            if read.get("ReadType","").strip() != "(Index)":
-                r = float(read.get(lane,{}).get("ErrRatePhiX","-1"))
-                # Only use the value if error rate is >0.0
-                if r > 0:
-                    phix_r.append(r)
+        """Get phix error rate. Returns -1 if error rate could not be determined
 
-        # If no results were found using the "old" structure, try the LIMS-parsed structure
-        if len(phix_r) == 0:
-            summary = fc.get("illumina",{}).get("run_summary",{})
-            data = summary.get(lane,{})
-            phix_r = [float(v) for k,v in data.items() if k.startswith("% Error Rate") and float(v) > 0]
-
-        # Return -1 if the error rate could not be determined
-        if len(phix_r) == 0:
-            return -1
-
-        return sum(phix_r)/len(phix_r)
+        :param lane: lane number, as a string or an integer
+        """
+        fc = self.get_entry(name)
+        # Lanes are keyed by strings in the document
+        return _phix_error_rates(fc).get(str(lane), -1)
 
     def get_instrument(self, name):
         """Get instrument id"""
         fc = self.get_entry(name)
         if not fc:
             return None
-        instrument = fc.get('RunInfo', {}).get('Instrument', None)
-        if not instrument:
-            instrument = fc.get('RunParameters', {}).get('Setup', {}).get('ScannerID', None)
-        return instrument
+        return _instrument(fc)
 
     def get_run_mode(self, name):
         """Get run mode"""
         fc = self.get_entry(name)
         if not fc:
             return None
-        run_mode = fc.get('RunParameters', {}).get('Setup', {}).get('RunMode', None)
-        return run_mode
+        return _run_mode(fc)
 
     def is_paired_end(self, name):
         """Get paired end status"""
         fc = self.get_entry(name)
         if not fc:
             return None
-        reads = fc.get('RunInfo', {}).get('Reads', [])
-        return len([read for read in reads if read.get('IsIndexedRead','N') == 'N']) == 2
+        return _is_paired_end(fc)
+
+    def get_flowcell_summary(self, name):
+        """Get instrument, run mode, paired end status and phix error
+        rates for all lanes of a flowcell from a single document fetch.
+
+        :param name: flowcell name
+
+        :returns: FlowcellSummary or None if the flowcell is not found
+        """
+        fc = self.get_entry(name)
+        if not fc:
+            return None
+        return _flowcell_summary(name, fc)
+
+    def get_flowcell_summaries(self, names):
+        """Get flowcell summaries for a list of flowcells, fetching all
+        documents in one request.
+
+        :param names: list of flowcell names
+
+        :returns: dictionary mapping flowcell name to FlowcellSummary, or None if not found
+        """
+        return {name: _flowcell_summary(name, fc) if fc else None
+                for name, fc in self.get_entries(names).items()}
 
     def get_storage_status(self, status):
         """Get all runs with the specified storage status.
+
+        Uses the status-keyed view of the statusdb design document, built
+        from info/storage_status, falling back to filtering the full
+        info/storage_status view if not installed. Both give the same result.
         """
+        from couchdb.http import ResourceNotFound
         self.log.info("Fetching all Flowcells with storage status \"{}\"".format(status))
-        return {run: info for run, info in self.storage_status_view.items() if info.get("storage_status") == status}
+        try:
+            rows = list(self.db.view(design.STORAGE_STATUS_VIEW, key=status))
+        except ResourceNotFound:
+            self.log.debug("View {} not found, filtering info/storage_status".format(design.STORAGE_STATUS_VIEW))
+            return {run: info for run, info in self.storage_status_view.items() if info.get("storage_status") == status}
+        # Rows carry [key, value] of the info/storage_status row they come from
+        return {row.value[0]: row.value[1] for row in rows}
 
     def set_storage_status(self, doc_id, status):
         """Sets the run storage status.
         """
-        db_run = self.db.get(doc_id)
-        if not db_run:
-            self.log.error("Document with id {} not found, could not update the " \
-                           "storage status")
-        else:
-            self.log.info("Updating storage status of run {} from {} to {}".format(
-                            db_run.get('RunInfo').get('Id'), db_run.get('storage_status'), status))
-            db_run['storage_status'] = status
-            save_couchdb_obj(self.db, db_run)
+        self.set_storage_status_many([doc_id], status)
+
+    def set_storage_status_many(self, doc_ids, status):
+        """Sets the storage status of several runs, fetching all documents
+        in one request and sending only the change of each, or saving them
+        all in one request if the patch update handler is not installed.
+
+        :param doc_ids: list of couchdb document ids
+        :param status: new storage status
+
+        :returns: dictionary mapping document id to 'updated', 'not updated',
+                  'not found', 'conflict' or the error reason
+        """
+        from couchdb.http import ResourceConflict
+        from statusdb.db.utils import patch_couchdb_obj
+        results = {}
+        runs = []
+        for doc_id, db_run in self._get_docs(doc_ids, use_mirror=False).items():
+            if not db_run:
+                self.log.error("Document with id %s not found, could not update the " \
+                               "storage status", doc_id, extra=PER_DOCUMENT)
+                results[doc_id] = 'not found'
+            elif db_run.get('storage_status') == status:
+                results[doc_id] = 'not updated'
+            else:
+                self.log.info("Updating storage status of run %s from %s to %s",
+                              db_run.get('RunInfo', {}).get('Id'), db_run.get('storage_status'), status,
+                              extra=PER_DOCUMENT)
+                run = dict(db_run)
+                run['storage_status'] = status
+                run['modification_time'] = datetime.utcnow().isoformat() + "Z"
+                runs.append((run, db_run))
+        # The documents were just read, so only the changes are sent, unless
+        # the patch update handler is not installed
+        whole = []
+        for run, db_run in runs:
+            try:
+                if patch_couchdb_obj(self.db, run, db_run):
+                    results[run['_id']] = 'updated'
+                else:
+                    whole.append(run)
+            except ResourceConflict:
+                self.log.warn("Conflict when updating storage status of document %s", run['_id'], extra=PER_DOCUMENT)
+                results[run['_id']] = 'conflict'
+            except Exception as e:
+                self.log.error("Could not update storage status of document %s: %s", run['_id'], e, extra=PER_DOCUMENT)
+                results[run['_id']] = str(e)
+        if whole:
+            for success, doc_id, rev_or_exc in self.db.update(whole):
+                if success:
+                    results[doc_id] = 'updated'
+                elif isinstance(rev_or_exc, ResourceConflict):
+                    self.log.warn("Conflict when updating storage status of document %s", doc_id, extra=PER_DOCUMENT)
+                    results[doc_id] = 'conflict'
+                else:
+                    self.log.error("Could not update storage status of document %s: %s", doc_id, rev_or_exc, extra=PER_DOCUMENT)
+                    results[doc_id] = str(rev_or_exc)
+        return results
 
 class ProjectSummaryConnection(Couch):
     _doc_type = ProjectSummaryDocument
     _update_fn = update_fn
+    name_view = lazy_view("project/project_name", "id", mirror_field="project_name", reduce=False)
+    id_view = lazy_view("project/project_id", "id", mirror_field="project_id", reduce=False)
     def __init__(self, dbname="projects", **kwargs):
         super(ProjectSummaryConnection, self).__init__(**kwargs)
         self.db = self.con[dbname]
-        self.name_view = {k.key:k.id for k in self.db.view("project/project_name", reduce=False)}
-        self.id_view = {k.key:k.id for k in self.db.view("project/project_id", reduce=False)}
+        # Latest library prep mappings, keyed by document id, as (rev, mapping)
+        self._library_preps = {}
 
     def set_db(self, dbname):
         """Make sure we don't change db from projects"""
@@ -480,16 +629,50 @@ class ProjectSummaryConnection(Couch):
         project = self.get_entry(project_name)
         if not project:
             return None
-        project_samples = project.get('samples', None)
+        return self._latest_library_preps(project)
+
+    def get_latest_library_preps(self, project_names, cache=False):
+        """Get mappings from project sample name to sample_run_metrics for
+        latest library prep, for many projects at once. Projects are
+        fetched in one request.
+
+        :param project_names: list of project names
+        :param cache: reuse mappings of projects whose revision has not
+                      changed since the last call, at the cost of one
+                      request for the revisions
+
+        :returns: dictionary mapping project name to the mapping of
+                  get_latest_library_prep, or None if no such project
+        """
+        if not cache:
+            return {name: self._latest_library_preps(project) if project else None
+                    for name, project in self.get_entries(project_names).items()}
+        results = {name: None for name in project_names}
+        ids = {doc_id: name for name, doc_id in self._view_lookup_many("name_view", list(results)).items()
+               if doc_id is not None}
+        revs = self._get_revs(list(ids))
+        changed = [doc_id for doc_id, rev in revs.items() if self._library_preps.get(doc_id, (None,))[0] != rev]
+        if changed:
+            self.log.debug("Fetching %d changed projects", len(changed))
+            # Cached by server revision, so the documents must match it
+            for doc_id, project in self._get_docs(changed, use_mirror=False).items():
+                if project is not None:
+                    self._library_preps[doc_id] = (project.get("_rev"),
+                                                   self._latest_library_preps(self._doc_type(**project)))
+        for doc_id, rev in revs.items():
+            if doc_id in self._library_preps:
+                results[ids[doc_id]] = self._library_preps[doc_id][1]
+        return results
+
+    def _latest_library_preps(self, project):
         map_d = {}
-        for project_sample_name,sample in project_samples.items():
-            if sample.get('library_prep', None):
-                library_preps = sample.get('library_prep')
-                lkeys = list(library_preps.keys())
-                lkeys.sort(reverse=True)
-                map_d[project_sample_name] = {k:kk for kk in lkeys[0] for k, v in library_preps[kk].get('sample_run_metrics', {}).items()} if library_preps else None
+        for project_sample_name, sample in (project.get('samples', None) or {}).items():
+            library_preps = sample.get('library_prep', None)
+            if library_preps:
+                latest = max(library_preps)
+                map_d[project_sample_name] = {k: latest for k in library_preps[latest].get('sample_run_metrics', {})}
             else:
-                self.log.warn("No library_prep information for project sample {}".format(project_sample_name))
+                self.log.warn("No library_prep information for project sample %s", project_sample_name, extra=PER_DOCUMENT)
         return map_d
 
     def get_info_source(self, project_name):
@@ -0,0 +1,162 @@
+"""Design documents shipped with the statusdb package"""
+
+DESIGN_NAME = "statusdb"
+DESIGN_ID = "_design/" + DESIGN_NAME
+
+# View name as passed to couchdb.Database.view
+STORAGE_STATUS_VIEW = "statusdb/storage_status"
+
+# View of the info design document the storage status view is built from
+STORAGE_STATUS_SOURCE = ("info", "storage_status")
+
+# Update handler name, see statusdb.db.utils.patch_couchdb_obj
+PATCH_HANDLER = "patch"
+
+# Error of the update handler for a missing document, told apart from the
+# not_found of couchdb for a missing design document or handler
+PATCH_NOT_FOUND = "statusdb_doc_not_found"
+
+# Applies {"_rev": rev, "set": [[path, value], ...], "unset": [path, ...]}, where
+# paths are lists of keys, refusing with a conflict if the revision is not current
+_PATCH_UPDATE = (
+    "function(doc, req) {\n"
+    "  if (!doc) {\n"
+    "    return [null, {code: 404, json: {error: '" + PATCH_NOT_FOUND + "', reason: 'missing'}}];\n"
+    "  }\n"
+    "  var patch = JSON.parse(req.body);\n"
+    "  if (patch._rev !== doc._rev) {\n"
+    "    return [null, {code: 409, json: {error: 'conflict', reason: 'Document update conflict.'}}];\n"
+    "  }\n"
+    "  function parent(path) {\n"
+    "    var obj = doc;\n"
+    "    for (var i = 0; i < path.length - 1; i++) {\n"
+    "      if (typeof obj[path[i]] !== 'object' || obj[path[i]] === null) {\n"
+    "        obj[path[i]] = {};\n"
+    "      }\n"
+    "      obj = obj[path[i]];\n"
+    "    }\n"
+    "    return obj;\n"
+    "  }\n"
+    "  (patch.set || []).forEach(function(op) {\n"
+    "    parent(op[0])[op[0][op[0].length - 1]] = op[1];\n"
+    "  });\n"
+    "  (patch.unset || []).forEach(function(path) {\n"
+    "    delete parent(path)[path[path.length - 1]];\n"
+    "  });\n"
+    "  return [doc, {json: {ok: true, id: doc._id}}];\n"
+    "}"
+)
+
+# Design document content, per database name
+DESIGN_DOCS = {
+    "projects": {
+        "language": "javascript",
+        "updates": {PATCH_HANDLER: _PATCH_UPDATE},
+    },
+    "samples": {
+        "language": "javascript",
+        "updates": {PATCH_HANDLER: _PATCH_UPDATE},
+    },
+    "analysis": {
+        "language": "javascript",
+        "updates": {PATCH_HANDLER: _PATCH_UPDATE},
+    },
+    "flowcells": {
+        "language": "javascript",
+        "updates": {PATCH_HANDLER: _PATCH_UPDATE},
+    },
+}
+
+
+def _storage_status_view(db):
+    """Build the storage status view from the installed info/storage_status.
+
+    The map function of info/storage_status is wrapped with its own emit,
+    so that every row it emits is emitted again keyed by its storage
+    status, with [key, value] of the original row as value. Lookups by
+    status then return exactly what filtering info/storage_status would.
+
+    :param db: couch database
+
+    :returns: view dictionary, or None if info/storage_status is not installed
+    """
+    ddoc, view = STORAGE_STATUS_SOURCE
+    source = db.get("_design/" + ddoc)
+    map_fn = ((source or {}).get("views") or {}).get(view, {}).get("map")
+    if map_fn is None:
+        return None
+    return {"map": "function(doc) {\n"
+                   "  (function(emit) {\n"
+                   "    return " + map_fn.strip() + ";\n"
+                   "  })(function(key, value) {\n"
+                   "    if (value && value.storage_status !== undefined) {\n"
+                   "      emit(value.storage_status, [key, value]);\n"
+                   "    }\n"
+                   "  })(doc);\n"
+                   "}"}
+
+
+def _design_doc(db, dbname):
+    """Design document content of a database, with the views built from
+    the ones already installed."""
+    design = DESIGN_DOCS.get(dbname)
+    if design is None:
+        raise KeyError("No statusdb design document for database '{}'".format(dbname))
+    design = dict(design)
+    if dbname == "flowcells":
+        # Without info/storage_status any older view is removed, not kept
+        view = _storage_status_view(db)
+        design["views"] = {STORAGE_STATUS_VIEW.split("/")[1]: view} if view else {}
+    return design
+
+
+def ensure_design_doc(db, dbname):
+    """Install or update the statusdb design document of a database.
+
+    :param db: couch database
+    :param dbname: database name, key in DESIGN_DOCS
+
+    :returns: True if the design document was written, False if already up to date
+    """
+    design = _design_doc(db, dbname)
+    current = db.get(DESIGN_ID)
+    if current is not None and all(current.get(k) == v for k, v in design.items()):
+        return False
+    doc = dict(design)
+    doc["_id"] = DESIGN_ID
+    if current is not None:
+        doc["_rev"] = current["_rev"]
+    db.save(doc)
+    return True
+
+
+# Design document holding the Mango indexes, separate from the javascript one
+MANGO_DESIGN_NAME = "statusdb_mango"
+
+# Fields of the Mango indexes for common queries, per database name
+MANGO_INDEXES = {
+    "projects": [["project_name"], ["project_id"], ["application"], ["source"]],
+    "samples": [["name"], ["project_id"], ["sample_prj"], ["flowcell"], ["barcode_name"]],
+    "flowcells": [["name"], ["RunInfo.Id"], ["RunInfo.Instrument"], ["storage_status"]],
+    "analysis": [["project_name"]],
+}
+
+
+def ensure_mango_indexes(db, dbname):
+    """Create the Mango indexes of a database that do not exist yet.
+
+    :param db: couch database
+    :param dbname: database name, key in MANGO_INDEXES
+
+    :returns: list of names of created indexes
+    """
+    created = []
+    for fields in MANGO_INDEXES.get(dbname, []):
+        name = "-".join(fields)
+        _, _, data = db.resource.post_json("_index", body={"index": {"fields": fields},
+                                                           "ddoc": MANGO_DESIGN_NAME,
+                                                           "name": name,
+                                                           "type": "json"})
+        if data.get("result") == "created":
+            created.append(name)
+    return created
@@ -0,0 +1,239 @@
+"""Partitioned export of statusdb databases to NDJSON or Parquet files
+
+The _all_docs key space of a database is split into contiguous ranges
+that are exported concurrently. Every partition is written as a series
+of chunk files, each finished chunk being recorded in a per-partition
+checkpoint so that an interrupted export resumes where it stopped.
+"""
+import gzip
+import json
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from statusdb.db.connections import StatusDocument, ProjectSummaryDocument, FlowcellRunMetricsDocument, \
+    SampleRunMetricsDocument, AnalysisDocument
+from statusdb.tools.log import minimal_logger
+
+LOG = minimal_logger(__name__)
+
+FORMATS = ["ndjson", "parquet"]
+
+_DOCUMENT_TYPES = {cls._entity_type: cls for cls in [StatusDocument, ProjectSummaryDocument,
+                                                      FlowcellRunMetricsDocument, SampleRunMetricsDocument,
+                                                      AnalysisDocument]}
+_BASE_FIELDS = ["_id", "_rev", "entity_type", "name", "creation_time", "modification_time"]
+
+
+def flatten_document(doc):
+    """Flatten a document to one level, using the field lists of the
+    document class of its entity type. Dict and list fields are JSON encoded.
+
+    :param doc: status document
+
+    :returns: flat dictionary
+    """
+    cls = _DOCUMENT_TYPES.get(doc.get("entity_type"), StatusDocument)
+    flat = {}
+    for f in _BASE_FIELDS + cls._fields:
+        v = doc.get(f)
+        flat[f] = json.dumps(v) if isinstance(v, (dict, list)) else v
+    for f in cls._dict_fields + cls._list_fields:
+        flat[f] = json.dumps(doc.get(f))
+    if cls is StatusDocument:
+        # Keep the whole document if there is no field list for the entity type
+        flat["doc"] = json.dumps(doc)
+    return flat
+
+def partition_keys(db, partitions):
+    """Split the document ids of a database into contiguous ranges of
+    about the same size. Design documents are left out.
+
+    :param db: couch database
+    :param partitions: number of ranges
+
+    :returns: list of (startkey, endkey) tuples, both inclusive
+    """
+    ids = [row.id for row in db.view("_all_docs") if not row.id.startswith("_design/")]
+    if not ids:
+        return []
+    size = -(-len(ids) // partitions)
+    return [(ids[i], ids[min(i + size, len(ids)) - 1]) for i in range(0, len(ids), size)]
+
+
+class Exporter(object):
+    """Export a database to compressed NDJSON or Parquet files.
+
+    :param db: couch database
+    :param outdir: output directory, also holding the manifest and checkpoints
+    :param fmt: output format, 'ndjson' or 'parquet'
+    :param partitions: number of key ranges
+    :param workers: number of concurrently exported partitions
+    :param batch_size: documents per _all_docs request
+    :param chunk_size: documents per output file
+    :param flatten: flatten documents with flatten_document, always done for parquet
+    """
+
+    def __init__(self, db, outdir, fmt="ndjson", partitions=16, workers=4,
+                 batch_size=500, chunk_size=20000, flatten=False):
+        if fmt not in FORMATS:
+            raise ValueError("Unknown export format '{}', use one of {}".format(fmt, ", ".join(FORMATS)))
+        self.db = db
+        self.outdir = outdir
+        self.fmt = fmt
+        self.partitions = partitions
+        self.workers = workers
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.flatten = flatten or fmt == "parquet"
+
+    def run(self):
+        """Export all partitions, resuming from checkpoints if present.
+
+        :returns: dictionary mapping partition number to number of exported documents
+        """
+        if not os.path.exists(self.outdir):
+            os.makedirs(self.outdir)
+        ranges = self._load_manifest()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = {i: pool.submit(self._export_partition, i, startkey, endkey)
+                       for i, (startkey, endkey) in enumerate(ranges)}
+            return {i: f.result() for i, f in futures.items()}
+
+    def _path(self, name):
+        return os.path.join(self.outdir, name)
+
+    def _write_json(self, name, obj):
+        # Write to a temporary file first so that an interruption never leaves a broken file
+        with open(self._path(name + ".tmp"), "w") as fh:
+            json.dump(obj, fh)
+        os.rename(self._path(name + ".tmp"), self._path(name))
+
+    def _load_manifest(self):
+        """Get the partition key ranges, from a previous run if any, so
+        that checkpoints stay valid."""
+        path = self._path("manifest.json")
+        if os.path.exists(path):
+            with open(path) as fh:
+                manifest = json.load(fh)
+            if manifest["format"] != self.fmt:
+                raise ValueError("{} holds a {} export".format(self.outdir, manifest["format"]))
+            return [tuple(r) for r in manifest["ranges"]]
+        ranges = partition_keys(self.db, self.partitions)
+        self._write_json("manifest.json", {"db": self.db.name, "format": self.fmt, "ranges": ranges})
+        return ranges
+
+    def _export_partition(self, i, startkey, endkey):
+        ckpt_name = "part-{:05d}.ckpt".format(i)
+        ckpt = {"last_key": None, "chunks": 0, "count": 0, "done": False}
+        if os.path.exists(self._path(ckpt_name)):
+            with open(self._path(ckpt_name)) as fh:
+                ckpt = json.load(fh)
+        if ckpt["done"]:
+            return ckpt["count"]
+        if ckpt["last_key"] is not None:
+            LOG.info("Resuming partition %d of %s after %s", i, self.db.name, ckpt["last_key"])
+
+        options = {"include_docs": True, "endkey": endkey, "limit": self.batch_size}
+        if ckpt["last_key"] is None:
+            options["startkey"] = startkey
+        else:
+            options.update(startkey=ckpt["last_key"], skip=1)
+        writer = None
+        while True:
+            rows = list(self.db.view("_all_docs", **options))
+            for row in rows:
+                if writer is None:
+                    writer = _CHUNK_WRITERS[self.fmt](self._path("part-{:05d}-{:05d}".format(i, ckpt["chunks"])))
+                doc = row.get("doc")
+                if doc is None or row.id.startswith("_design/"):
+                    continue
+                writer.write(flatten_document(doc) if self.flatten else doc)
+            if rows:
+                options.update(startkey=rows[-1].key, skip=1)
+            done = len(rows) < self.batch_size
+            if writer is not None and (done or writer.count >= self.chunk_size):
+                writer.close()
+                ckpt["chunks"] += 1
+                ckpt["count"] += writer.count
+                ckpt["last_key"] = options["startkey"]
+                ckpt["done"] = done
+                self._write_json(ckpt_name, ckpt)
+                writer = None
+            if done:
+                break
+        if not ckpt["done"]:
+            ckpt["done"] = True
+            self._write_json(ckpt_name, ckpt)
+        LOG.info("Exported %d documents in partition %d of %s", ckpt["count"], i, self.db.name)
+        return ckpt["count"]
+
+
+class _NdjsonChunkWriter(object):
+    """Stream documents to a gzip compressed NDJSON file"""
+
+    def __init__(self, path):
+        self.path = path + ".ndjson.gz"
+        self.count = 0
+        self._fh = gzip.open(self.path + ".tmp", "wt")
+
+    def write(self, doc):
+        self._fh.write(json.dumps(doc))
+        self._fh.write("\n")
+        self.count += 1
+
+    def close(self):
+        self._fh.close()
+        os.rename(self.path + ".tmp", self.path)
+
+
+class _ParquetChunkWriter(object):
+    """Write flattened documents of a chunk to a Parquet file, with all
+    columns stored as strings.
+
+    The columns are only known once the chunk is complete, so documents
+    are spooled to a temporary file meanwhile and then written from it in
+    row groups, holding at most one row group in memory.
+
+    :param path: output file path, without extension
+    :param row_group_size: documents per Parquet row group
+    """
+
+    def __init__(self, path, row_group_size=1000):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("Parquet export requires the pyarrow package")
+        self._pa = pyarrow
+        self.path = path + ".parquet"
+        self.row_group_size = row_group_size
+        self.count = 0
+        self._columns = set()
+        self._spool = tempfile.TemporaryFile("w+", dir=os.path.dirname(self.path) or None)
+
+    def write(self, doc):
+        row = {k: v if v is None or isinstance(v, str) else json.dumps(v) for k, v in doc.items()}
+        self._columns.update(row)
+        self._spool.write(json.dumps(row))
+        self._spool.write("\n")
+        self.count += 1
+
+    def close(self):
+        schema = self._pa.schema([(c, self._pa.string()) for c in sorted(self._columns)])
+        self._spool.seek(0)
+        writer = self._pa.parquet.ParquetWriter(self.path + ".tmp", schema, compression="zstd")
+        try:
+            rows = []
+            for line in self._spool:
+                rows.append(json.loads(line))
+                if len(rows) >= self.row_group_size:
+                    writer.write_table(self._pa.Table.from_pylist(rows, schema=schema))
+                    rows = []
+            if rows or not self.count:
+                writer.write_table(self._pa.Table.from_pylist(rows, schema=schema))
+        finally:
+            writer.close()
+            self._spool.close()
+        os.rename(self.path + ".tmp", self.path)
+
+_CHUNK_WRITERS = {"ndjson": _NdjsonChunkWriter, "parquet": _ParquetChunkWriter}
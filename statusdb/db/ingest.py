@@ -0,0 +1,169 @@
+"""Bulk ingestion of sample run metrics documents
+
+Documents are built and validated in a pool of processes, deduplicated
+by name, matched against existing documents in bulk and written through
+_bulk_docs by several threads at once. Existing documents are merged and
+skipped when unchanged, as SampleRunMetricsConnection.save does, but
+with a handful of requests per batch instead of several per document.
+"""
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from statusdb.db.connections import SampleRunMetricsDocument, utc_time, _equal_documents, _merge_db_document
+from statusdb.tools.log import minimal_logger, PER_DOCUMENT
+
+LOG = minimal_logger(__name__)
+
+# Fields making up the name of a sample run metrics document
+NAME_FIELDS = ["lane", "date", "flowcell", "sequence"]
+
+
+class IngestStats(object):
+    """Counters of an ingestion, updated as batches are written"""
+
+    def __init__(self, total=0):
+        self._lock = threading.Lock()
+        self.total = total
+        self.built = 0
+        self.invalid = 0
+        self.duplicates = 0
+        self.created = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.failed = 0
+        self.build_seconds = 0.0
+        self.write_seconds = 0.0
+        # Error messages, keyed by document name or input position
+        self.errors = {}
+
+    def add(self, **counts):
+        with self._lock:
+            for k, v in counts.items():
+                setattr(self, k, getattr(self, k) + v)
+
+    @property
+    def written(self):
+        return self.created + self.updated + self.unchanged + self.failed
+
+    def __repr__(self):
+        return ("<IngestStats total={} built={} invalid={} duplicates={} created={} updated={} unchanged={} "
+                "failed={} build={:.1f}s write={:.1f}s>").format(
+                    self.total, self.built, self.invalid, self.duplicates, self.created, self.updated,
+                    self.unchanged, self.failed, self.build_seconds, self.write_seconds)
+
+
+def _log_progress(stats):
+    LOG.info("Ingested %d of %d documents: %r", stats.written, stats.built - stats.duplicates, stats)
+
+
+def _build_documents(records):
+    """Build documents from a chunk of records, in a worker process.
+
+    :returns: list of (document, None) or (None, error message)
+    """
+    results = []
+    for kw in records:
+        missing = [f for f in NAME_FIELDS if kw.get(f) is None]
+        if missing:
+            results.append((None, "missing {}".format(", ".join(missing))))
+            continue
+        try:
+            results.append((dict(SampleRunMetricsDocument(**kw)), None))
+        except Exception as e:
+            results.append((None, "{}: {}".format(type(e).__name__, e)))
+    return results
+
+
+def ingest_sample_run_metrics(con, records, processes=None, writers=4, batch_size=500, progress=None):
+    """Create or update sample run metrics documents in bulk.
+
+    :param con: object of type <SampleRunMetricsConnection>
+    :param records: list of dictionaries of SampleRunMetricsDocument keyword arguments
+    :param processes: number of processes building documents, the number of CPUs if None
+    :param writers: number of batches written concurrently
+    :param batch_size: documents per lookup and _bulk_docs request
+    :param progress: function called with the IngestStats after every batch,
+                     from the writer threads; by default the progress is logged
+
+    :returns: IngestStats
+    """
+    records = list(records)
+    stats = IngestStats(len(records))
+    progress = progress or _log_progress
+
+    # Build documents in parallel; the last document of a name wins
+    start = time.time()
+    docs = OrderedDict()
+    chunks = [records[i:i + batch_size] for i in range(0, len(records), batch_size)]
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        for i, results in enumerate(pool.map(_build_documents, chunks)):
+            for j, (doc, error) in enumerate(results):
+                if doc is None:
+                    stats.invalid += 1
+                    stats.errors[i * batch_size + j] = error
+                    continue
+                stats.built += 1
+                if doc["name"] in docs:
+                    stats.duplicates += 1
+                    del docs[doc["name"]]
+                docs[doc["name"]] = doc
+    stats.build_seconds = time.time() - start
+    LOG.info("Built %d documents (%d invalid, %d duplicates) in %.1f s",
+             stats.built, stats.invalid, stats.duplicates, stats.build_seconds)
+
+    start = time.time()
+    docs = list(docs.values())
+    batches = [docs[i:i + batch_size] for i in range(0, len(docs), batch_size)]
+    with ThreadPoolExecutor(max_workers=writers) as pool:
+        for _ in pool.map(lambda batch: _write_batch(con, batch, stats, progress), batches):
+            pass
+    stats.write_seconds = time.time() - start
+    LOG.info("Ingested %d documents: %r", len(docs), stats)
+    return stats
+
+
+def _write_batch(con, batch, stats, progress):
+    """Merge a batch of documents with existing ones and write the changed ones"""
+    try:
+        ids = con._view_lookup_many("name_view", [doc["name"] for doc in batch], use_mirror=False,
+                                     use_loaded=False)
+        dbobjs = con._get_docs([i for i in set(ids.values()) if i is not None], use_mirror=False)
+        t_utc = utc_time()
+        to_save = []
+        # Whether each document to save is new, known before the update
+        # adds a _rev to every document it saves
+        created = []
+        unchanged = 0
+        for doc in batch:
+            dbobj = dbobjs.get(ids[doc["name"]]) if ids[doc["name"]] else None
+            if dbobj is None:
+                doc["creation_time"] = t_utc
+                to_save.append(doc)
+                created.append(True)
+            elif _equal_documents(doc, dbobj):
+                unchanged += 1
+            else:
+                to_save.append(_merge_db_document(doc, dbobj, t_utc))
+                created.append(False)
+        results = con.db.update(to_save) if to_save else []
+    except Exception as e:
+        LOG.error("Could not write batch of %d documents: %s", len(batch), e)
+        with stats._lock:
+            stats.failed += len(batch)
+            stats.errors.update((doc["name"], str(e)) for doc in batch)
+        progress(stats)
+        return
+    counts = {"created": 0, "updated": 0, "unchanged": unchanged, "failed": 0}
+    errors = {}
+    for doc, new, (success, doc_id, rev_or_exc) in zip(to_save, created, results):
+        if success:
+            counts["created" if new else "updated"] += 1
+        else:
+            LOG.warn("Could not save document %s: %s", doc["name"], rev_or_exc, extra=PER_DOCUMENT)
+            counts["failed"] += 1
+            errors[doc["name"]] = str(rev_or_exc)
+    with stats._lock:
+        stats.errors.update(errors)
+    stats.add(**counts)
+    progress(stats)
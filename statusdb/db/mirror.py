@@ -0,0 +1,190 @@
+"""Local read-only mirror of statusdb databases
+
+Documents are copied into an SQLite file and kept current from the
+CouchDB _changes feed. Connections created with a mirror serve document
+reads from it and fall back to the server for missing documents and
+for all writes.
+"""
+import json
+import sqlite3
+import threading
+from statusdb.tools.log import minimal_logger
+
+LOG = minimal_logger(__name__)
+
+# Document fields with an index in the mirror, with their JSON path
+INDEXED_FIELDS = {
+    "name": "$.name",
+    "project_name": "$.project_name",
+    "project_id": "$.project_id",
+    "sample_prj": "$.sample_prj",
+    "flowcell": "$.flowcell",
+}
+
+_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS docs (db TEXT NOT NULL, id TEXT NOT NULL, rev TEXT, "
+    "doc TEXT NOT NULL, PRIMARY KEY (db, id))",
+    "CREATE TABLE IF NOT EXISTS seqs (db TEXT PRIMARY KEY, seq TEXT NOT NULL)",
+] + ["CREATE INDEX IF NOT EXISTS docs_{0} ON docs (db, json_extract(doc, '{1}'))".format(field, path)
+     for field, path in INDEXED_FIELDS.items()]
+
+
+class LocalMirror(object):
+    """Read-only local copy of statusdb databases in an SQLite file.
+
+    Each thread gets its own SQLite connection, so the path should be a
+    file rather than ':memory:' if the mirror is shared between threads.
+
+    :param path: path to the SQLite file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._stop = threading.Event()
+        self._thread = None
+        with self._con() as con:
+            for statement in _SCHEMA:
+                con.execute(statement)
+
+    def _con(self):
+        con = getattr(self._local, "con", None)
+        if con is None:
+            con = sqlite3.connect(self.path)
+            self._local.con = con
+        return con
+
+    def get(self, dbname, doc_id):
+        """Get a document from the mirror.
+
+        :param dbname: database name
+        :param doc_id: couchdb document id
+
+        :returns: document or None if not mirrored
+        """
+        row = self._con().execute("SELECT doc FROM docs WHERE db = ? AND id = ?",
+                                  (dbname, doc_id)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_many(self, dbname, doc_ids):
+        """Get several documents from the mirror.
+
+        :param dbname: database name
+        :param doc_ids: list of couchdb document ids
+
+        :returns: dictionary mapping document id to document, for mirrored documents only
+        """
+        docs = {}
+        doc_ids = list(doc_ids)
+        # Stay below the SQLite limit on the number of query parameters
+        for i in range(0, len(doc_ids), 500):
+            chunk = doc_ids[i:i + 500]
+            query = "SELECT id, doc FROM docs WHERE db = ? AND id IN ({})".format(",".join("?" * len(chunk)))
+            for doc_id, doc in self._con().execute(query, [dbname] + chunk):
+                docs[doc_id] = json.loads(doc)
+        return docs
+
+    def find(self, dbname, field, value):
+        """Get all mirrored documents with a given value of an indexed field.
+
+        :param dbname: database name
+        :param field: field name, key in INDEXED_FIELDS
+        :param value: field value
+
+        :returns: list of documents
+        """
+        if field not in INDEXED_FIELDS:
+            raise KeyError("Field '{}' is not indexed in the mirror, use one of {}".format(
+                field, ", ".join(sorted(INDEXED_FIELDS))))
+        query = "SELECT doc FROM docs WHERE db = ? AND json_extract(doc, '{}') = ?".format(INDEXED_FIELDS[field])
+        return [json.loads(row[0]) for row in self._con().execute(query, (dbname, value))]
+
+    def find_ids(self, dbname, field, values):
+        """Get the ids of mirrored documents with given values of an indexed
+        field, the largest id for values shared by several documents, as the
+        last row of a couchdb view keyed by the field.
+
+        :param dbname: database name
+        :param field: field name, key in INDEXED_FIELDS
+        :param values: list of field values
+
+        :returns: dictionary mapping field value to document id, for mirrored values only
+        """
+        if field not in INDEXED_FIELDS:
+            raise KeyError("Field '{}' is not indexed in the mirror, use one of {}".format(
+                field, ", ".join(sorted(INDEXED_FIELDS))))
+        ids = {}
+        values = list(values)
+        for i in range(0, len(values), 500):
+            chunk = values[i:i + 500]
+            query = ("SELECT json_extract(doc, '{0}'), MAX(id) FROM docs WHERE db = ? AND json_extract(doc, '{0}') "
+                     "IN ({1}) GROUP BY json_extract(doc, '{0}')").format(INDEXED_FIELDS[field],
+                                                                         ",".join("?" * len(chunk)))
+            for value, doc_id in self._con().execute(query, [dbname] + chunk):
+                ids[value] = doc_id
+        return ids
+
+    def sync(self, db, batch_size=1000):
+        """Apply all changes of a couch database since the last sync.
+
+        :param db: couch database
+        :param batch_size: number of changes to fetch per request
+
+        :returns: number of changes applied
+        """
+        dbname = db.name
+        con = self._con()
+        row = con.execute("SELECT seq FROM seqs WHERE db = ?", (dbname,)).fetchone()
+        since = json.loads(row[0]) if row else 0
+        applied = 0
+        while True:
+            data = db.changes(since=since, include_docs=True, limit=batch_size)
+            results = data.get("results", [])
+            with con:
+                for change in results:
+                    if change["id"].startswith("_design/"):
+                        continue
+                    if change.get("deleted"):
+                        con.execute("DELETE FROM docs WHERE db = ? AND id = ?", (dbname, change["id"]))
+                    else:
+                        doc = change["doc"]
+                        con.execute("INSERT OR REPLACE INTO docs (db, id, rev, doc) VALUES (?, ?, ?, ?)",
+                                    (dbname, doc["_id"], doc.get("_rev"), json.dumps(doc)))
+                since = data.get("last_seq", since)
+                con.execute("INSERT OR REPLACE INTO seqs (db, seq) VALUES (?, ?)", (dbname, json.dumps(since)))
+            applied += len(results)
+            if len(results) < batch_size:
+                break
+        LOG.debug("Applied %d changes from %s to mirror %s", applied, dbname, self.path)
+        return applied
+
+    def start(self, dbs, interval=60):
+        """Keep the mirror current in a background thread.
+
+        :param dbs: list of couch databases to sync
+        :param interval: seconds between syncs
+        """
+        if self._thread is not None:
+            return
+        self._stop.clear()
+
+        def follow():
+            while not self._stop.is_set():
+                for db in dbs:
+                    try:
+                        self.sync(db)
+                    except Exception as e:
+                        LOG.warn("Could not sync mirror of %s: %s", db.name, e)
+                self._stop.wait(interval)
+
+        self._thread = threading.Thread(target=follow, name="statusdb-mirror")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background sync thread, if running."""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
@@ -0,0 +1,141 @@
+"""Request policy for couchdb connections: timeouts, retries with
+backoff, hedged reads and a circuit breaker"""
+import random
+import socket
+import threading
+import time
+try:
+    import http.client as httplib
+except ImportError:
+    import httplib
+from couchdb.http import ResourceConflict, ServerError
+from statusdb.db import ConnectionError
+
+# Server responses worth retrying
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+# POST requests that only read from the database
+_READ_POSTS = ("/_all_docs", "/_find", "/_explain", "/_changes")
+
+
+class CircuitOpenError(ConnectionError):
+    """Exception raised instead of sending requests while the circuit
+    breaker is open."""
+    pass
+
+
+def is_transient(exc):
+    """Whether an exception raised by a request is worth retrying"""
+    if isinstance(exc, ServerError):
+        return exc.args[0][0] in RETRY_STATUSES
+    return isinstance(exc, (socket.error, socket.timeout, httplib.HTTPException))
+
+
+class RequestPolicy(object):
+    """Timeouts, retries and hedging used by StatusdbSession.
+
+    :param read_timeout: socket timeout in seconds for reads, None for no timeout
+    :param write_timeout: socket timeout in seconds for writes, None for no timeout
+    :param retries: number of retries of reads failing with a transient error
+    :param backoff: base delay in seconds, doubled for every retry
+    :param max_backoff: longest delay between retries, in seconds
+    :param hedge_after: send a duplicate of a read still running after this many
+                        seconds and use whichever answers first, None to disable
+    :param breaker_threshold: consecutive transient failures opening the circuit breaker
+    :param breaker_reset: seconds the circuit breaker stays open before a trial request
+    :param conflict_retries: number of retries of saves failing with a conflict
+    """
+
+    def __init__(self, read_timeout=60, write_timeout=300, retries=4, backoff=0.5, max_backoff=30,
+                 hedge_after=None, breaker_threshold=5, breaker_reset=30, conflict_retries=3):
+        self.read_timeout = read_timeout
+        self.write_timeout = write_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge_after = hedge_after
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+        self.conflict_retries = conflict_retries
+
+    def is_idempotent(self, method, url):
+        """Whether a request only reads and can safely be retried or duplicated"""
+        if method in ("GET", "HEAD"):
+            return True
+        if method == "POST":
+            path = url.split("?", 1)[0].rstrip("/")
+            return path.endswith(_READ_POSTS) or "/_view/" in path
+        return False
+
+    def timeout(self, idempotent):
+        return self.read_timeout if idempotent else self.write_timeout
+
+    def retry_delays(self):
+        """Delays before each retry, exponential with full jitter"""
+        for attempt in range(self.retries):
+            yield random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+
+class CircuitBreaker(object):
+    """Fail fast after repeated transient failures, letting a single
+    trial request through once reset seconds have passed.
+
+    :param threshold: consecutive failures opening the breaker
+    :param reset: seconds before a trial request is let through
+    """
+
+    def __init__(self, threshold=5, reset=30):
+        self.threshold = threshold
+        self.reset = reset
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def before(self):
+        """Raise CircuitOpenError if requests should not be sent
+
+        :returns: True if the request is the trial one, whose outcome must
+                  be reported with success, failure or release
+        """
+        with self._lock:
+            if self.opened_at is None:
+                return False
+            if time.time() - self.opened_at < self.reset or self._trial:
+                raise CircuitOpenError("Circuit breaker open after {} consecutive failures".format(self.failures))
+            self._trial = True
+            return True
+
+    def release(self):
+        """End the trial without telling whether the server is up, e.g. when
+        it failed on the client side, letting the next request be the trial"""
+        with self._lock:
+            self._trial = False
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or (self.threshold and self.failures >= self.threshold):
+                self.opened_at = time.time()
+            self._trial = False
+
+
+def retry_on_conflict(fn, retries=3):
+    """Call fn, calling it again if it raises ResourceConflict. fn is
+    expected to fetch the current revision itself.
+
+    :param fn: function without arguments
+    :param retries: number of retries
+    """
+    for attempt in range(retries + 1):
+        try:
+            return fn()
+        except ResourceConflict:
+            if attempt == retries:
+                raise
@@ -0,0 +1,144 @@
+"""Materialized per-project reports joining projects, sample runs and flowcells
+
+Documents are fetched in bulk per database and cached by revision, so
+that regenerating the report of an unchanged project only costs a few
+revision lookups, and a changed one only refetches the documents that moved.
+"""
+from statusdb.db.connections import _barcode_lane_statistics
+from statusdb.db.design import MANGO_DESIGN_NAME
+from statusdb.db.utils import sample_qc_data, customer_name_data
+from statusdb.tools.log import minimal_logger
+
+LOG = minimal_logger(__name__)
+
+STAT_VIEW = "names/Barcode_lane_stat"
+
+# Mango index of the samples database finding the sample runs of a project
+SAMPLE_PRJ_INDEX = [MANGO_DESIGN_NAME, "sample_prj"]
+
+
+class ReportMaterializer(object):
+    """Build delivery reports for projects from the projects, samples
+    and, optionally, flowcells databases.
+
+    Sample runs of a project are found through the sample_prj Mango index
+    of the samples database, created on first use if missing, see
+    statusdb.db.design.MANGO_INDEXES.
+
+    :param p_con: object of type <ProjectSummaryConnection>
+    :param s_con: object of type <SampleRunMetricsConnection>
+    :param f_con: object of type <FlowcellRunMetricsConnection>, to add lane statistics
+    """
+
+    def __init__(self, p_con, s_con, f_con=None):
+        self.p_con = p_con
+        self.s_con = s_con
+        self.f_con = f_con
+        # Documents and flowcell lane statistics, keyed by id, as (rev, value)
+        self._docs = {}
+        self._stats = {}
+        # Reports, keyed by project name, as (revisions, report)
+        self._reports = {}
+        self._indexed = False
+
+    def materialize(self, project_name, get_barcode_seq=False):
+        """Get the report of a project, rebuilt only if any of its source
+        documents has changed.
+
+        :param project_name: project name
+        :param get_barcode_seq: add barcode sequences
+
+        :returns: dictionary with project information and, per sample run name,
+                  qc data, scilife and customer names and lane statistics
+        """
+        project_id = self.p_con._view_lookup("name_view", project_name)
+        if project_id is None:
+            LOG.warn("no project '%s'", project_name)
+            return None
+        # Membership is queried every time, sample runs come and go
+        self._ensure_index()
+        sample_ids = [doc["_id"] for doc in self.s_con.find_all({"sample_prj": project_name}, fields=["_id"],
+                                                                use_index=SAMPLE_PRJ_INDEX)]
+        revs = self.p_con._get_revs([project_id])
+        revs.update(self.s_con._get_revs(sample_ids))
+        self._fetch(self.p_con, [project_id], revs)
+        self._fetch(self.s_con, sample_ids, revs)
+        samples = [self._docs[i][1] for i in sample_ids if i in self._docs]
+
+        flowcell_ids = {}
+        if self.f_con is not None:
+            flowcell_ids = self._flowcell_ids(samples)
+            revs.update(self.f_con._get_revs(list(set(flowcell_ids.values()))))
+            self._fetch_stats(flowcell_ids, revs)
+
+        key = frozenset(revs.items())
+        cached = self._reports.get((project_name, get_barcode_seq))
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        report = self._build(self._docs[project_id][1], samples, flowcell_ids, get_barcode_seq)
+        self._reports[(project_name, get_barcode_seq)] = (key, report)
+        return report
+
+    def _ensure_index(self):
+        """Create the Mango indexes of the samples database once, without
+        which every membership query scans the whole database"""
+        if self._indexed:
+            return
+        try:
+            created = self.s_con.ensure_indexes()
+        except Exception as e:
+            LOG.warn("Could not create the Mango indexes of %s, project membership queries will be slow: %s",
+                     self.s_con.db, e)
+        else:
+            if created:
+                LOG.info("Created Mango indexes %s", ", ".join(created))
+        self._indexed = True
+
+    def _fetch(self, con, doc_ids, revs):
+        """Fetch documents whose revision differs from the cached one"""
+        changed = [i for i in doc_ids if i in revs and self._docs.get(i, (None,))[0] != revs[i]]
+        if changed:
+            LOG.debug("Fetching %d changed documents", len(changed))
+            # Cached by server revision, so the documents must match it
+            for doc_id, doc in con._get_docs(changed, use_mirror=False).items():
+                if doc is not None:
+                    self._docs[doc_id] = (doc.get("_rev"), doc)
+
+    def _flowcell_ids(self, samples):
+        """Map flowcell names of sample runs to flowcell document ids"""
+        names = set()
+        for s in samples:
+            names.update(["{}_{}".format(s.get("date"), s.get("flowcell")), s.get("flowcell")])
+        return {name: doc_id for name, doc_id in self.f_con._view_lookup_many("name_view", list(names)).items()
+                if doc_id is not None}
+
+    def _fetch_stats(self, flowcell_ids, revs):
+        """Fetch lane statistics of flowcells whose revision has changed"""
+        changed = [name for name, i in flowcell_ids.items() if self._stats.get(name, (None,))[0] != revs.get(i)]
+        if changed:
+            rows = self.f_con.db.view(STAT_VIEW, keys=changed, reduce=False)
+            values = {row.key: row.value for row in rows}
+            for name in changed:
+                self._stats[name] = (revs.get(flowcell_ids[name]), values.get(name))
+
+    def _build(self, project, samples, flowcell_ids, get_barcode_seq):
+        application = project.get("application", None)
+        project_samples = project.get("samples", None)
+        report = {"project_name": project.get("project_name"),
+                  "project_id": project.get("project_id"),
+                  "application": application,
+                  "samples": {}}
+        for s in samples:
+            row = sample_qc_data(s, application)
+            row.update(customer_name_data(s, project_samples, get_barcode_seq))
+            if self.f_con is not None:
+                stats = None
+                for name in ["{}_{}".format(s.get("date"), s.get("flowcell")), s.get("flowcell")]:
+                    if name in flowcell_ids:
+                        stats = self._stats[name][1]
+                        break
+                (row["mean_quality"], row["q30_bases"]) = _barcode_lane_statistics(
+                    stats, s.get("sample_prj"), s.get("barcode_name"), s.get("lane")) if stats else (None, None)
+            report["samples"][s["name"]] = row
+        return report
+
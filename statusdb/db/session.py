@@ -0,0 +1,337 @@
+"""HTTP session and JSON codec used for couchdb connections
+
+The session asks the server for gzip compressed responses, decompresses
+them transparently and can gzip large request bodies. Responses are
+decoded with orjson when available. Requests follow a RequestPolicy for
+timeouts, retries, hedging and circuit breaking. Concurrent identical
+reads share one request and its undecoded response, see
+statusdb.db.singleflight.
+"""
+import gzip
+import io
+import json
+import zlib
+import threading
+import time
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+try:
+    import http.client as httplib
+except ImportError:
+    import httplib
+from couchdb import http
+from couchdb import json as couch_json
+from statusdb.db.policy import RequestPolicy, CircuitBreaker, is_transient
+from statusdb.db.singleflight import FLIGHTS
+from statusdb.tools.log import minimal_logger
+
+LOG = minimal_logger(__name__)
+
+JSON_CODECS = ["auto", "orjson", "json"]
+
+
+# Session a thread last sent a request with, to count the time spent
+# decoding its responses, which couchdb does outside of the session
+_LOCAL = threading.local()
+
+
+def _timed(decode):
+    """Wrap a decode function to count its time in the stats of the
+    session the current thread last used"""
+    def timed_decode(string):
+        start = time.time()
+        try:
+            return decode(string)
+        finally:
+            stats = getattr(_LOCAL, "stats", None)
+            if stats is not None:
+                stats.add(decodes=1, decode_seconds=time.time() - start)
+    return timed_decode
+
+
+def use_json_codec(codec="auto"):
+    """Set the JSON codec couchdb uses to decode and encode documents.
+    Note that the codec is process wide. Decoding is timed, see TransferStats.
+
+    :param codec: 'orjson', 'json' (the standard library) or 'auto' to use
+                  orjson if it is installed and json otherwise
+
+    :returns: name of the codec in use
+    """
+    if codec not in JSON_CODECS:
+        raise ValueError("Unknown JSON codec '{}', use one of {}".format(codec, ", ".join(JSON_CODECS)))
+    if codec in ("auto", "orjson"):
+        try:
+            import orjson
+        except ImportError:
+            if codec == "orjson":
+                raise
+        else:
+            couch_json.use(decode=_timed(orjson.loads),
+                           encode=lambda obj: orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode("utf-8"))
+            return "orjson"
+    # As couchdb does with the json module
+    couch_json.use(decode=_timed(json.loads),
+                   encode=lambda obj: json.dumps(obj, allow_nan=False, ensure_ascii=False))
+    return "json"
+
+
+class TransferStats(object):
+    """Counters of requests, and bytes sent and received by a session.
+    bytes_received are counted on the wire, bytes_decoded once
+    decompressed, and decode_seconds is the time spent decoding JSON
+    responses to python objects."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.retries = 0
+        self.hedged = 0
+        self.coalesced = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.bytes_decoded = 0
+        self.decodes = 0
+        self.decode_seconds = 0.0
+
+    def add(self, **counts):
+        with self._lock:
+            for k, v in counts.items():
+                setattr(self, k, getattr(self, k) + v)
+
+    def snapshot(self):
+        """:returns: dictionary of the current counts"""
+        with self._lock:
+            return {k: v for k, v in vars(self).items() if not k.startswith("_")}
+
+    def __repr__(self):
+        return ("<TransferStats requests={} retries={} hedged={} coalesced={} sent={} received={} decoded={} "
+                "decode_seconds={:.3f}>").format(self.requests, self.retries, self.hedged, self.coalesced,
+                                                 self.bytes_sent, self.bytes_received, self.bytes_decoded,
+                                                 self.decode_seconds)
+
+
+class GzipHTTPResponse(httplib.HTTPResponse):
+    """HTTP response that decompresses gzip encoded bodies on read and
+    counts bytes received on the wire"""
+    stats = None
+
+    def begin(self):
+        httplib.HTTPResponse.begin(self)
+        self._decoder = None
+        self._buffer = b""
+        if (self.getheader("content-encoding") or "").lower() == "gzip":
+            self._decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def _read_raw(self, amt=None):
+        data = httplib.HTTPResponse.read(self, amt)
+        if self.stats is not None:
+            self.stats.add(bytes_received=len(data))
+        return data
+
+    def read(self, amt=None):
+        if self._decoder is None:
+            data = self._read_raw(amt)
+        elif amt is None:
+            data = self._buffer + self._decoder.decompress(self._read_raw()) + self._decoder.flush()
+            self._buffer = b""
+        else:
+            while len(self._buffer) < amt:
+                chunk = self._read_raw(amt)
+                if not chunk:
+                    self._buffer += self._decoder.flush()
+                    break
+                self._buffer += self._decoder.decompress(chunk)
+            data, self._buffer = self._buffer[:amt], self._buffer[amt:]
+        if self.stats is not None:
+            self.stats.add(bytes_decoded=len(data))
+        return data
+
+
+class _GzipConnectionPool(http.ConnectionPool):
+    """Connection pool handing out connections that use GzipHTTPResponse,
+    with the socket timeout of the current request"""
+
+    def __init__(self, timeout, stats, disable_ssl_verification=False):
+        http.ConnectionPool.__init__(self, timeout, disable_ssl_verification=disable_ssl_verification)
+        self.response_class = type("GzipHTTPResponse", (GzipHTTPResponse,), {"stats": stats})
+        self.local = threading.local()
+
+    def get(self, url):
+        timeout = getattr(self.local, "timeout", self.timeout)
+        scheme, host = http.util.urlsplit(url, "http", False)[:2]
+        with self.lock:
+            conns = self.conns.setdefault((scheme, host), [])
+            conn = conns.pop(-1) if conns else None
+        if conn is None:
+            # Made here rather than by the base class so that connecting,
+            # including the TLS handshake, is bounded by the request timeout
+            if scheme == "http":
+                cls = http.HTTPConnection
+            elif scheme == "https":
+                cls = http.InsecureHTTPSConnection if self.disable_ssl_verification else http.HTTPSConnection
+            else:
+                raise ValueError("{} is not a supported scheme".format(scheme))
+            conn = cls(host, timeout=timeout)
+            conn.connect()
+        conn.response_class = self.response_class
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        return conn
+
+
+def _start(fn):
+    """Call fn on a new daemon thread.
+
+    :returns: Future of the result of fn
+    """
+    future = Future()
+
+    def run():
+        try:
+            future.set_result(fn())
+        except BaseException as e:
+            future.set_exception(e)
+    thread = threading.Thread(target=run, name="statusdb-hedge")
+    thread.daemon = True
+    thread.start()
+    return future
+
+
+def _buffered(result):
+    """Read the whole body of a response, to share it between callers"""
+    status, msg, data = result
+    return status, msg, data.read() if hasattr(data, "read") else data
+
+
+def _discard(future):
+    """Release the connection held by the response of a losing hedged request"""
+    if future.exception() is None:
+        data = future.result()[2]
+        if hasattr(data, "close"):
+            data.close()
+
+
+class StatusdbSession(http.Session):
+    """couchdb http.Session negotiating gzip compressed responses,
+    optionally compressing request bodies and sending requests according
+    to a RequestPolicy.
+
+    :param compress_requests: gzip JSON request bodies of at least min_compress_size bytes
+    :param min_compress_size: smallest request body to compress, in bytes
+    :param policy: RequestPolicy, default settings if not given
+    :param single_flight: share the response of concurrent identical reads
+    :param kwargs: passed to couchdb.http.Session
+    """
+
+    def __init__(self, compress_requests=False, min_compress_size=16384, policy=None, single_flight=True, **kwargs):
+        http.Session.__init__(self, **kwargs)
+        self.compress_requests = compress_requests
+        self.min_compress_size = min_compress_size
+        self.single_flight = single_flight
+        self.policy = policy or RequestPolicy()
+        self.breaker = CircuitBreaker(self.policy.breaker_threshold, self.policy.breaker_reset)
+        self.stats = TransferStats()
+        self.connection_pool = _GzipConnectionPool(self._timeout, self.stats)
+
+    def disable_ssl_verification(self):
+        http.Session.disable_ssl_verification(self)
+        self.connection_pool = _GzipConnectionPool(self._timeout, self.stats, disable_ssl_verification=True)
+
+    def request(self, method, url, body=None, headers=None, credentials=None, num_redirects=0):
+        _LOCAL.stats = self.stats
+        headers = dict(headers or {})
+        # Feeds are read line by line from the socket, bypassing the
+        # decompression of GzipHTTPResponse; they are also not snapshots,
+        # and continuous ones never end, so they are never shared
+        feed = "/_changes" in url
+        if not feed:
+            headers.setdefault("Accept-Encoding", "gzip")
+        if body is not None and not isinstance(body, (str, bytes)) and not hasattr(body, "read"):
+            body = couch_json.encode(body).encode("utf-8")
+            headers.setdefault("Content-Type", "application/json")
+            if self.compress_requests and len(body) >= self.min_compress_size:
+                body = gzip.compress(body)
+                headers["Content-Encoding"] = "gzip"
+        # Streamed bodies can not be sent twice
+        idempotent = self.policy.is_idempotent(method.upper(), url) and not hasattr(body, "read")
+        timeout = self.policy.timeout(idempotent)
+
+        def send():
+            self.connection_pool.local.timeout = timeout
+            self.stats.add(requests=1, bytes_sent=len(body) if isinstance(body, (str, bytes)) else 0)
+            return http.Session.request(self, method, url, body=body, headers=dict(headers),
+                                        credentials=credentials, num_redirects=num_redirects)
+
+        if idempotent and self.single_flight and not feed:
+            key = (method.upper(), url, body, credentials, tuple(sorted(headers.items())))
+            status, msg, data = FLIGHTS.do(key, lambda: _buffered(self._send(method, url, send, idempotent)), self.stats)
+            # Every caller reads, and decodes, a body of its own
+            return status, msg, io.BytesIO(data) if data is not None else None
+        return self._send(method, url, send, idempotent)
+
+    def _send(self, method, url, send, idempotent):
+        """Send a request according to the policy: retried if idempotent,
+        hedged if idempotent and configured, and through the breaker.
+
+        :param method: HTTP method, for logging
+        :param url: request url, for logging
+        :param send: function without arguments sending the request once
+        :param idempotent: whether the request can safely be sent again
+        """
+        delays = self.policy.retry_delays() if idempotent else iter(())
+        while True:
+            trial = self.breaker.before()
+            try:
+                if idempotent and self.policy.hedge_after is not None:
+                    result = self._hedged(send)
+                else:
+                    result = send()
+            except Exception as e:
+                if not is_transient(e):
+                    # The server answered, so it is up
+                    if isinstance(e, http.HTTPError):
+                        self.breaker.success()
+                    elif trial:
+                        self.breaker.release()
+                    raise
+                self.breaker.failure()
+                delay = next(delays, None)
+                if delay is None:
+                    raise
+                LOG.debug("Retrying %s %s in %.2f s after %r", method, http.extract_credentials(url)[0], delay, e)
+                self.stats.add(retries=1)
+                time.sleep(delay)
+            except BaseException:
+                if trial:
+                    self.breaker.release()
+                raise
+            else:
+                self.breaker.success()
+                return result
+
+    def _hedged(self, send):
+        """Send a read, and a duplicate if no answer came within
+        hedge_after seconds, returning the first successful response.
+
+        Every request gets a thread of its own rather than one from a
+        fixed pool, where requests of concurrent callers would queue and
+        be hedged for waiting on each other rather than on the server.
+        """
+        futures = [_start(send)]
+        done, _ = wait(futures, timeout=self.policy.hedge_after)
+        if not done:
+            self.stats.add(hedged=1)
+            futures.append(_start(send))
+        pending = set(futures)
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for f in done:
+                if f.exception() is None:
+                    for other in futures:
+                        if other is not f:
+                            other.add_done_callback(_discard)
+                    return f.result()
+                error = f.exception()
+        raise error
@@ -0,0 +1,84 @@
+"""Coalescing of concurrent identical reads
+
+While a read is in flight, threads asking for the same thing wait for
+its result instead of sending their own request. Nothing is kept once
+the read has completed, so this is not a cache: a read started after
+another finished always goes to the server.
+
+Results are shared as they are, so calls should return something
+immutable: StatusdbSession shares the undecoded bytes of a response, and
+every caller decodes its own copy of the documents.
+"""
+import threading
+from statusdb.tools.log import minimal_logger
+
+LOG = minimal_logger(__name__)
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.waiters = 0
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Run at most one call per key at a time, sharing its outcome with
+    callers arriving while it runs. All callers get the same result
+    object, which should therefore be immutable.
+
+    :param stats: object with an add(**counts) method, e.g. TransferStats,
+                  counting waiters as 'coalesced'
+    """
+
+    def __init__(self, stats=None):
+        self.stats = stats
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, stats=None):
+        """Call fn, or wait for the result of a running call with the same key.
+
+        :param key: hashable key identifying the read
+        :param fn: function without arguments
+        :param stats: counters to use instead of the default ones
+
+        :returns: result of fn
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                leader = True
+            else:
+                call.waiters += 1
+                leader = False
+        if not leader:
+            stats = stats or self.stats
+            if stats is not None:
+                stats.add(coalesced=1)
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            self._finish(key, call)
+            raise
+        self._finish(key, call)
+        return call.result
+
+    def _finish(self, key, call):
+        """Stop new callers from joining a call, and wake its waiters"""
+        with self._lock:
+            del self._calls[key]
+        if call.waiters:
+            LOG.debug("Shared a read with %d waiting callers", call.waiters)
+        call.done.set()
+
+
+# Shared by all connections of the process
+FLIGHTS = SingleFlight()
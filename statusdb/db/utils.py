@@ -1,12 +1,12 @@
 #!/usr/bin/env python
 from uuid import uuid4
 from datetime import datetime
-import yaml
-import couchdb
 
 
 def load_couch_server(config_file):
     """loads couch server with settings specified in 'config_file'"""
+    import yaml
+    import couchdb
     try:
         stream = open(config_file,'r')
         db_conf = yaml.load(stream, Loader=yaml.SafeLoader)['statusdb']
@@ -21,27 +21,113 @@ def find_or_make_key(key):
         key = uuid4().hex
     return key
 
-def save_couchdb_obj(db, obj, add_time_log=True):
-    """Updates ocr creates the object obj in database db."""
-    dbobj = db.get(obj['_id'])
+# Databases found to lack the statusdb patch update handler
+_NO_PATCH_HANDLER = set()
+
+def save_couchdb_obj(db, obj, add_time_log=True, conflict_retries=3, base=None):
+    """Updates ocr creates the object obj in database db.
+
+    Changes to an existing document are sent as a patch to the statusdb
+    update handler when installed, otherwise the whole document is saved.
+    The save is redone with the new revision if the document was changed
+    in the database in the meantime, at most conflict_retries times.
+
+    :param base: the document as last read from the database, if known,
+                 saving the request fetching it
+    """
+    from statusdb.db.policy import retry_on_conflict
+    bases = [base] if base is not None else []
+    # Only the first attempt can use base, retries fetch the current document
+    return retry_on_conflict(lambda: _save_couchdb_obj(db, obj, add_time_log, bases.pop() if bases else None),
+                             conflict_retries)
+
+def _save_couchdb_obj(db, obj, add_time_log=True, dbobj=None):
+    if dbobj is None:
+        dbobj = db.get(obj['_id'])
     time_log = datetime.utcnow().isoformat() + "Z"
     if dbobj is None:
+        # Set by an earlier attempt if the document was deleted in between
+        obj.pop("_rev", None)
         if add_time_log:
             obj["creation_time"] = time_log
             obj["modification_time"] = time_log
         db.save(obj)
         return 'created'
     else:
+        orig_dbobj = dbobj
+        dbobj = dict(dbobj)
         obj["_rev"] = dbobj.get("_rev")
         if add_time_log:
             obj["modification_time"] = time_log
             dbobj["modification_time"] = time_log
             obj["creation_time"] = dbobj["creation_time"]
         if not comp_obj(obj, dbobj):
-            db.save(obj)
+            # A conflict of the patch is raised for save_couchdb_obj to retry
+            # with a fresh read, instead of uploading the whole document in vain
+            if not patch_couchdb_obj(db, obj, orig_dbobj):
+                db.save(obj)
             return 'uppdated'
     return 'not uppdated'
 
+def diff_couchdb_obj(dbobj, obj, path=()):
+    """Compute the changes turning dbobj into obj. Nested dictionaries are
+    compared key by key, all other values as a whole. Top level keys
+    starting with an underscore are left out.
+
+    :returns: tuple of list of [path, value] to set and list of paths to unset
+    """
+    set_ops = []
+    unset_ops = []
+    for key, value in obj.items():
+        if not path and key.startswith("_"):
+            continue
+        if key not in dbobj:
+            set_ops.append([list(path) + [key], value])
+        elif isinstance(value, dict) and isinstance(dbobj[key], dict):
+            s, u = diff_couchdb_obj(dbobj[key], value, path + (key,))
+            set_ops.extend(s)
+            unset_ops.extend(u)
+        elif value != dbobj[key]:
+            set_ops.append([list(path) + [key], value])
+    for key in dbobj:
+        if key not in obj and not (not path and key.startswith("_")):
+            unset_ops.append(list(path) + [key])
+    return set_ops, unset_ops
+
+def patch_couchdb_obj(db, obj, dbobj):
+    """Save the changes from dbobj to obj through the statusdb patch
+    update handler, without uploading the whole document.
+
+    :param db: couch database
+    :param obj: new version of the document
+    :param dbobj: document as last read from the database, with its _rev
+
+    :returns: True if patched, False if there is no update handler, so that
+              it has to be saved whole
+
+    :raises ResourceConflict: if the document has changed or been deleted in
+                              the database since dbobj was read
+    """
+    from couchdb.http import ResourceConflict, ResourceNotFound
+    from statusdb.db import design
+    if db.resource.url in _NO_PATCH_HANDLER:
+        return False
+    set_ops, unset_ops = diff_couchdb_obj(dbobj, obj)
+    patch = {"_rev": dbobj["_rev"], "set": set_ops, "unset": unset_ops}
+    try:
+        _, headers, _ = db.resource.post_json(["_design", design.DESIGN_NAME, "_update", design.PATCH_HANDLER,
+                                               obj["_id"]], body=patch)
+    except ResourceNotFound as e:
+        if e.args and isinstance(e.args[0], tuple) and e.args[0][0] == design.PATCH_NOT_FOUND:
+            # The handler is there, the document is gone; saving it whole with
+            # the same _rev would conflict too, so let the caller re-read
+            raise ResourceConflict(e.args[0])
+        # The design document or the handler is not installed, do not try again
+        _NO_PATCH_HANDLER.add(db.resource.url)
+        return False
+    obj["_rev"] = headers.get("X-Couch-Update-NewRev", obj.get("_rev"))
+    return True
+
 def comp_obj(obj, dbobj):
     ####temporary
     if 'entity_type' in dbobj and dbobj['entity_type']=='project_summary':
@@ -140,6 +226,39 @@ def calc_avg_qv(srm):
     except:
         return None
 
+def sample_qc_data(s, application=None):
+    """Get qc data for a sample run.
+
+    :param s: sample_run_metrics document
+    :param application: application of the project
+
+    :returns: dictionary of qc results
+    """
+    qcdata = {"sample":s.get("barcode_name", None),
+              "project":s.get("sample_prj", None),
+              "lane":s.get("lane", None),
+              "flowcell":s.get("flowcell", None),
+              "date":s.get("date", None),
+              "application":application,
+              "TOTAL_READS":int(s.get("picard_metrics", {}).get("AL_PAIR", {}).get("TOTAL_READS", -1)),
+              "PERCENT_DUPLICATION":s.get("picard_metrics", {}).get("DUP_metrics", {}).get("PERCENT_DUPLICATION", "-1.0"),
+              "MEAN_INSERT_SIZE":float(s.get("picard_metrics", {}).get("INS_metrics", {}).get("MEAN_INSERT_SIZE", "-1.0").replace(",", ".")),
+              "GENOME_SIZE":int(s.get("picard_metrics", {}).get("HS_metrics", {}).get("GENOME_SIZE", -1)),
+              "FOLD_ENRICHMENT":float(s.get("picard_metrics", {}).get("HS_metrics", {}).get("FOLD_ENRICHMENT", "-1.0").replace(",", ".")),
+              "PCT_USABLE_BASES_ON_TARGET":s.get("picard_metrics", {}).get("HS_metrics", {}).get("PCT_USABLE_BASES_ON_TARGET", "-1.0"),
+              "PCT_TARGET_BASES_10X":s.get("picard_metrics", {}).get("HS_metrics", {}).get("PCT_TARGET_BASES_10X", "-1.0"),
+              "PCT_PF_READS_ALIGNED":s.get("picard_metrics", {}).get("AL_PAIR", {}).get("PCT_PF_READS_ALIGNED", "-1.0"),
+              }
+    target_territory = float(s.get("picard_metrics", {}).get("HS_metrics", {}).get("TARGET_TERRITORY", -1))
+    pct_labels = ["PERCENT_DUPLICATION", "PCT_USABLE_BASES_ON_TARGET", "PCT_TARGET_BASES_10X",
+                  "PCT_PF_READS_ALIGNED"]
+    for l in pct_labels:
+        if qcdata[l]:
+            qcdata[l] = float(qcdata[l].replace(",", ".")) * 100
+    if qcdata["FOLD_ENRICHMENT"] and qcdata["GENOME_SIZE"] and target_territory:
+        qcdata["PERCENT_ON_TARGET"] = float(qcdata["FOLD_ENRICHMENT"]/ (float(qcdata["GENOME_SIZE"]) / float(target_territory))) * 100
+    return qcdata
+
 def get_qc_data(sample_prj, p_con, s_con, fc_id=None):
     """Get qc data for a project, possibly subset by flowcell.
 
@@ -152,32 +271,28 @@ def get_qc_data(sample_prj, p_con, s_con, fc_id=None):
     project = p_con.get_entry(sample_prj)
     application = project.get("application", None) if project else None
     samples = s_con.get_samples(fc_id=fc_id, sample_prj=sample_prj)
-    qcdata = {}
-    for s in samples:
-        qcdata[s["name"]]={"sample":s.get("barcode_name", None),
-                           "project":s.get("sample_prj", None),
-                           "lane":s.get("lane", None),
-                           "flowcell":s.get("flowcell", None),
-                           "date":s.get("date", None),
-                           "application":application,
-                           "TOTAL_READS":int(s.get("picard_metrics", {}).get("AL_PAIR", {}).get("TOTAL_READS", -1)),
-                           "PERCENT_DUPLICATION":s.get("picard_metrics", {}).get("DUP_metrics", {}).get("PERCENT_DUPLICATION", "-1.0"),
-                           "MEAN_INSERT_SIZE":float(s.get("picard_metrics", {}).get("INS_metrics", {}).get("MEAN_INSERT_SIZE", "-1.0").replace(",", ".")),
-                           "GENOME_SIZE":int(s.get("picard_metrics", {}).get("HS_metrics", {}).get("GENOME_SIZE", -1)),
-                           "FOLD_ENRICHMENT":float(s.get("picard_metrics", {}).get("HS_metrics", {}).get("FOLD_ENRICHMENT", "-1.0").replace(",", ".")),
-                           "PCT_USABLE_BASES_ON_TARGET":s.get("picard_metrics", {}).get("HS_metrics", {}).get("PCT_USABLE_BASES_ON_TARGET", "-1.0"),
-                           "PCT_TARGET_BASES_10X":s.get("picard_metrics", {}).get("HS_metrics", {}).get("PCT_TARGET_BASES_10X", "-1.0"),
-                           "PCT_PF_READS_ALIGNED":s.get("picard_metrics", {}).get("AL_PAIR", {}).get("PCT_PF_READS_ALIGNED", "-1.0"),
-                           }
-        target_territory = float(s.get("picard_metrics", {}).get("HS_metrics", {}).get("TARGET_TERRITORY", -1))
-        pct_labels = ["PERCENT_DUPLICATION", "PCT_USABLE_BASES_ON_TARGET", "PCT_TARGET_BASES_10X",
-                      "PCT_PF_READS_ALIGNED"]
-        for l in pct_labels:
-            if qcdata[s["name"]][l]:
-                qcdata[s["name"]][l] = float(qcdata[s["name"]][l].replace(",", ".")) * 100
-        if qcdata[s["name"]]["FOLD_ENRICHMENT"] and qcdata[s["name"]]["GENOME_SIZE"] and target_territory:
-            qcdata[s["name"]]["PERCENT_ON_TARGET"] = float(qcdata[s["name"]]["FOLD_ENRICHMENT"]/ (float(qcdata[s["name"]]["GENOME_SIZE"]) / float(target_territory))) * 100
-    return qcdata
+    return {s["name"]: sample_qc_data(s, application) for s in samples}
+
+def customer_name_data(samp, project_samples, get_barcode_seq=False):
+    """Get scilife and customer name, and optionally barcode, of a sample run.
+
+    :param samp: sample_run_metrics document
+    :param project_samples: samples of the project_summary document
+
+    :returns: dictionary with scilife name, customer name and barcode (optional);
+              the barcode name and no customer name if no project sample matches
+    """
+    from statusdb.db.connections import _match_barcode_name_to_project_sample
+    bcname = samp.get("barcode_name", None)
+    s = _match_barcode_name_to_project_sample(bcname, project_samples) if bcname else None
+    # Sample runs not matching a project sample keep their barcode name
+    project_sample = s['project_sample'] if s else {}
+    name = {'scilife_name': project_sample.get('scilife_name', bcname),
+            'customer_name' : project_sample.get('customer_name', None)
+            }
+    if get_barcode_seq:
+        name["barcode_seq"] = samp.get("sequence", None)
+    return name
 
 def get_scilife_to_customer_name(project_name, p_con, s_con, get_barcode_seq=False):
     """Get scilife to customer name mapping optionally with barcodes, represented as a
@@ -190,13 +305,7 @@ def get_scilife_to_customer_name(project_name, p_con, s_con, get_barcode_seq=Fal
 
     :returns: dictionary with keys scilife name and values customer name and barcodes(optional)
     """
-    name_d = {}
-    for samp in s_con.get_samples(sample_prj=project_name):
-        bcname = samp.get("barcode_name", None)
-        s = p_con.get_project_sample(project_name, bcname)
-        name_d[bcname] = {'scilife_name': s['project_sample'].get('scilife_name', bcname),
-                          'customer_name' : s['project_sample'].get('customer_name', None)
-                          }
-        if get_barcode_seq:
-            name_d[bcname]["barcode_seq"] = samp.get("sequence", None)
-    return name_d
+    project = p_con.get_entry(project_name)
+    project_samples = project.get('samples', None) if project else None
+    return {samp.get("barcode_name", None): customer_name_data(samp, project_samples, get_barcode_seq)
+            for samp in s_con.get_samples(sample_prj=project_name)}
@@ -0,0 +1,189 @@
+"""Write-behind buffer saving documents in batches from a background thread"""
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from datetime import datetime
+from uuid import uuid4
+from statusdb.tools.log import minimal_logger, PER_DOCUMENT
+
+LOG = minimal_logger(__name__)
+
+
+class WriteBehindQueue(object):
+    """Buffer documents and save them in batches through _bulk_docs from
+    a background thread.
+
+    Given a connection with an update function, documents are matched to
+    existing ones by name, in bulk, and merged with them as
+    Couch.save does; unchanged documents are not written. Otherwise
+    documents are matched by _id and written over the current revision,
+    as save_couchdb_obj does, keeping the creation_time of the database
+    document. Repeated writes of the same document before it is flushed
+    are coalesced to the last one. Use flush(), or the queue as a context
+    manager, to make sure everything enqueued so far has been written.
+
+    :param db: couch database
+    :param max_batch: flush when this many documents are waiting
+    :param max_delay: flush documents that have waited this many seconds
+    :param add_time_log: set modification_time, and creation_time of new documents
+    :param con: connection whose name_view and update function to use, if any
+    """
+
+    def __init__(self, db, max_batch=500, max_delay=1.0, add_time_log=True, con=None):
+        self.db = db
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.add_time_log = add_time_log
+        self.con = con if con is not None and con._update_fn else None
+        self._pending = OrderedDict()
+        self._first_put = None
+        self._inflight = 0
+        self._flushing = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="statusdb-write-behind")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, doc):
+        """Enqueue a document for saving.
+
+        :param doc: document to save
+
+        :returns: Future resolving to the new revision, or raising the save error
+        """
+        future = Future()
+        doc.setdefault("_id", uuid4().hex)
+        # Documents are identified by name when matched by name
+        key = doc["name"] if self.con is not None and doc.get("name") else doc["_id"]
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Write-behind queue is closed")
+            if key in self._pending:
+                # Only the last write of a document is saved, all callers get its result
+                futures = self._pending.pop(key)[1]
+                LOG.debug("Coalescing write of document %s", key, extra=PER_DOCUMENT)
+            else:
+                futures = []
+            futures.append(future)
+            self._pending[key] = (doc, futures)
+            if self._first_put is None:
+                self._first_put = time.time()
+            self._cond.notify_all()
+        return future
+
+    def flush(self):
+        """Block until all documents enqueued so far have been written."""
+        with self._cond:
+            self._flushing += 1
+            self._cond.notify_all()
+            while self._pending or self._inflight:
+                self._cond.wait()
+            self._flushing -= 1
+
+    def close(self):
+        """Flush and stop the background thread."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                while (self._pending and len(self._pending) < self.max_batch and not self._flushing
+                       and not self._closed):
+                    remaining = self._first_put + self.max_delay - time.time()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                if not self._pending and self._closed:
+                    return
+                batch = []
+                while self._pending and len(batch) < self.max_batch:
+                    batch.append(self._pending.popitem(last=False)[1])
+                self._first_put = time.time() if self._pending else None
+                self._inflight += 1
+            try:
+                self._write(batch)
+            finally:
+                with self._cond:
+                    self._inflight -= 1
+                    self._cond.notify_all()
+
+    def _write(self, batch):
+        try:
+            results = self._save(batch)
+        except Exception as e:
+            LOG.error("Could not write batch of %d documents: %s", len(batch), e)
+            for _, futures in batch:
+                for future in futures:
+                    future.set_exception(e)
+            return
+        LOG.debug("Wrote batch of %d documents", len(batch))
+        for (_, futures), (success, doc_id, rev_or_exc) in zip(batch, results):
+            if not success:
+                LOG.warn("Could not save document %s: %s", doc_id, rev_or_exc, extra=PER_DOCUMENT)
+            for future in futures:
+                if success:
+                    future.set_result(rev_or_exc)
+                else:
+                    future.set_exception(rev_or_exc)
+
+    def _save(self, batch):
+        """Match a batch with the database documents and write the changed ones
+
+        :returns: list of (success, id, rev_or_exc) per document, as couchdb.Database.update
+        """
+        from statusdb.db.connections import utc_time, _equal_documents, _merge_db_document
+        docs = [doc for doc, _ in batch]
+        # Database document id per document, by name or by _id
+        ids = {}
+        if self.con is not None:
+            named = [doc["name"] for doc in docs if doc.get("name")]
+            by_name = self.con._view_lookup_many("name_view", named, use_mirror=False, use_loaded=False) \
+                if named else {}
+            ids = {i: by_name[doc["name"]] for i, doc in enumerate(docs)
+                   if doc.get("name") and by_name[doc["name"]] is not None}
+        for i, doc in enumerate(docs):
+            if i not in ids and "_rev" not in doc:
+                ids[i] = doc["_id"]
+        dbobjs = {}
+        if ids:
+            # Straight from the server, the revisions must be current
+            dbobjs = {row.key: row.doc for row in self.db.view("_all_docs", keys=list(set(ids.values())),
+                                                               include_docs=True)
+                      if row.get("doc")}
+        time_log = utc_time() if self.con is not None else datetime.utcnow().isoformat() + "Z"
+        results = [None] * len(docs)
+        to_save = []
+        for i, doc in enumerate(docs):
+            dbobj = dbobjs.get(ids.get(i))
+            if dbobj is not None and _equal_documents(doc, dbobj):
+                results[i] = (True, dbobj["_id"], dbobj["_rev"])
+                continue
+            if dbobj is not None and self.con is not None:
+                _merge_db_document(doc, dbobj, time_log)
+            elif dbobj is not None:
+                doc["_rev"] = dbobj["_rev"]
+                if self.add_time_log:
+                    doc["modification_time"] = time_log
+                    doc["creation_time"] = dbobj.get("creation_time", time_log)
+            elif self.add_time_log:
+                doc["modification_time"] = time_log
+                if "_rev" not in doc:
+                    doc["creation_time"] = time_log
+            to_save.append(i)
+        if to_save:
+            for i, result in zip(to_save, self.db.update([docs[i] for i in to_save])):
+                results[i] = result
+        return results
@@ -1,21 +1,37 @@
 """ Load and parse configuration file
 """
-import yaml
+import copy
 import os
 
+# Parsed configurations, keyed by (path, modification time)
+_CONFIG_CACHE = {}
+
 def load_config(config_file=None):
     """Loads a configuration file.
 
     By default it assumes ~/.ngi_config/statusdb.yaml
+
+    Parsed files are cached per process and only re-read if their
+    modification time changes.
     """
     try:
-        yaml_config = os.path.join(os.environ.get('HOME'), '.ngi_config', 'statusdb.yaml')
-        if not os.path.exists(yaml_config):
-            yaml_config = os.path.join(os.environ.get("STATUS_DB_CONFIG"))
-        config=config_file or yaml_config
-        with open(config) as f:
-            conf = yaml.load(f, Loader=yaml.SafeLoader)
-            return conf
-    except IOError:
+        config = config_file
+        if not config:
+            config = os.path.join(os.environ.get('HOME'), '.ngi_config', 'statusdb.yaml')
+            if not os.path.exists(config):
+                config = os.path.join(os.environ.get("STATUS_DB_CONFIG"))
+        key = (os.path.abspath(config), os.stat(config).st_mtime)
+        if key not in _CONFIG_CACHE:
+            # Imported here since yaml is slow to import
+            import yaml
+            with open(config) as f:
+                conf = yaml.load(f, Loader=yaml.SafeLoader)
+            # Drop stale entries for the same file
+            for k in [k for k in _CONFIG_CACHE if k[0] == key[0]]:
+                del _CONFIG_CACHE[k]
+            _CONFIG_CACHE[key] = conf
+        # Return a copy so that callers can not modify the cached configuration
+        return copy.deepcopy(_CONFIG_CACHE[key])
+    except (IOError, OSError):
         raise IOError(("There was a problem loading the configuration file. "
                 "Please make sure that {} can be opened".format(config)))
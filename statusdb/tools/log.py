@@ -2,11 +2,68 @@
 """
 import os
 import sys
+import atexit
+import itertools
 import logging
 
+# Pass as extra to mark messages logged once per document, which can be
+# sampled; warnings and errors are never sampled
+PER_DOCUMENT = {"per_document": True}
+
+_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Handler attached by minimal_logger, per namespace
+_handlers = {}
+# Queue and background listener, when queue logging is enabled
+_queue = None
+_listener = None
+
+
+class SamplingFilter(logging.Filter):
+    """Only let through every n:th per-document message below WARNING,
+    all other messages are always let through, so that no failure is
+    hidden by sampling.
+
+    :param int every: keep one of this many per-document messages
+    """
+
+    def __init__(self, every=1):
+        logging.Filter.__init__(self)
+        self.every = every
+        self._counter = itertools.count()
+
+    def filter(self, record):
+        if self.every <= 1 or record.levelno >= logging.WARNING or not getattr(record, "per_document", False):
+            return True
+        return next(self._counter) % self.every == 0
+
+_sampler = SamplingFilter()
+
+
+def _make_handler(log_level):
+    if _queue is not None:
+        from logging.handlers import QueueHandler
+        handler = QueueHandler(_queue)
+    else:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter(_FORMAT))
+    handler.setLevel(log_level)
+    handler.addFilter(_sampler)
+    return handler
+
+def _replace_handlers():
+    for namespace, old in list(_handlers.items()):
+        log = logging.getLogger(namespace)
+        new = _make_handler(old.level)
+        log.removeHandler(old)
+        log.addHandler(new)
+        _handlers[namespace] = new
+
 def minimal_logger(namespace, debug=False):
     """Make and return a minimal console logger. Optionally write to a file as well.
 
+    Calling it several times for the same namespace does not add more handlers.
+
     :param str namespace: Namespace of logger
     :param bool debug: Log in DEBUG level or not
 
@@ -18,9 +75,47 @@ def minimal_logger(namespace, debug=False):
     log.setLevel(log_level)
 
     # Logs to console
+    if namespace not in _handlers:
+        _handlers[namespace] = _make_handler(log_level)
+        log.addHandler(_handlers[namespace])
+    else:
+        _handlers[namespace].setLevel(log_level)
+    return log
+
+def enable_queue_logging(sample_every=1):
+    """Write messages from all minimal loggers through a queue, emptied
+    to the console by a background thread, so that logging calls never
+    block on output.
+
+    :param int sample_every: only log one of this many per-document messages
+                             below WARNING
+    """
+    global _queue, _listener
+    _sampler.every = sample_every
+    if _listener is not None:
+        return
+    try:
+        import queue
+    except ImportError:
+        import Queue as queue
+    from logging.handlers import QueueListener
     s_h = logging.StreamHandler()
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    s_h.setFormatter(formatter)
-    s_h.setLevel(log_level)
-    log.addHandler(s_h)
-    return log
\ No newline at end of file
+    s_h.setFormatter(logging.Formatter(_FORMAT))
+    _queue = queue.Queue(-1)
+    _listener = QueueListener(_queue, s_h)
+    _listener.start()
+    _replace_handlers()
+
+def disable_queue_logging():
+    """Flush queued messages, stop the background thread and log
+    directly to the console again."""
+    global _queue, _listener
+    _sampler.every = 1
+    if _listener is None:
+        return
+    _queue = None
+    _replace_handlers()
+    _listener.stop()
+    _listener = None
+
+atexit.register(disable_queue_logging)
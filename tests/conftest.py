@@ -0,0 +1,16 @@
+import pytest
+from tests.fault_server import FaultServer, StallServer
+
+
+@pytest.fixture
+def fault_server():
+    server = FaultServer()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def stall_server():
+    server = StallServer()
+    yield server
+    server.close()
@@ -0,0 +1,137 @@
+"""Local stand-in for a couchdb server injecting faults into its responses"""
+import gzip
+import json
+import socket
+import threading
+import time
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # Room for many concurrent clients connecting at once
+    request_queue_size = 128
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up on delayed or dropped answers are expected
+        pass
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _handle(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+        fault = self.server.fault_server._next(self.command, self.path, dict(self.headers))
+        delay = fault.get("delay", self.server.fault_server.latency)
+        if delay:
+            time.sleep(delay)
+        if fault.get("drop"):
+            # Hang up without answering
+            self.close_connection = True
+            return
+        status = fault.get("status", 200)
+        body = json.dumps(fault.get("body", {"ok": True} if status < 400 else
+                                    {"error": "injected", "reason": "status {}".format(status)})).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        if fault.get("gzip"):
+            body = gzip.compress(body)
+            self.send_header("Content-Encoding", "gzip")
+        if fault.get("chunked"):
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for i in range(0, len(body), 1000):
+                self.wfile.write("{:x}\r\n".format(len(body[i:i + 1000])).encode("ascii") + body[i:i + 1000] + b"\r\n")
+            self.wfile.write(b"0\r\n\r\n")
+            return
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_HEAD = do_POST = do_PUT = do_DELETE = _handle
+
+
+class FaultServer(object):
+    """HTTP server answering every request with {"ok": true}, unless a
+    queued fault says otherwise.
+
+    Faults are dictionaries, used by requests in the order they arrive:
+    'status' to answer with, 'delay' in seconds before answering, 'drop'
+    to hang up without answering, 'body' to answer with, 'gzip' to
+    compress it and 'chunked' to send it in chunks. Request headers are
+    recorded in 'headers', in the order of 'requests'.
+
+    :param latency: delay in seconds of requests without a fault
+    """
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.requests = []
+        self.headers = []
+        self._faults = []
+        self._lock = threading.Lock()
+        self._server = _ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self._server.fault_server = self
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self._server.server_address[1])
+
+    def inject(self, *faults):
+        with self._lock:
+            self._faults.extend(faults)
+
+    def _next(self, method, path, headers):
+        with self._lock:
+            self.requests.append((method, path))
+            self.headers.append(headers)
+            return self._faults.pop(0) if self._faults else {}
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class StallServer(object):
+    """TCP server accepting connections and never sending anything, like
+    a node stalled in the middle of a TLS handshake."""
+
+    def __init__(self):
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.bind(("127.0.0.1", 0))
+        self._sock.listen(16)
+        self._conns = []
+        self._thread = threading.Thread(target=self._accept)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def url(self):
+        return "https://127.0.0.1:{}".format(self._sock.getsockname()[1])
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self._sock.accept()
+            except (OSError, socket.error):
+                return
+            self._conns.append(conn)
+
+    def close(self):
+        self._sock.close()
+        for conn in self._conns:
+            conn.close()
@@ -0,0 +1,66 @@
+"""statusdb query command line against stub connections"""
+import io
+import json
+import threading
+import pytest
+from statusdb import cli
+from statusdb.db.connections import FlowcellRunMetricsConnection
+
+
+class _Flowcells(object):
+    """Flowcell lookups, answering 'slow' only once 'fast' has been answered"""
+
+    def __init__(self):
+        self.fast_done = threading.Event()
+
+    def get_entry(self, name):
+        if name == "slow":
+            assert self.fast_done.wait(5)
+        elif name == "fast":
+            self.fast_done.set()
+        elif name == "missing":
+            raise KeyError(name)
+        return {"name": name, "illumina": {"run_summary": {"1": {"% Error Rate R1": "0.5"}}}}
+
+    get_phix_error_rate = FlowcellRunMetricsConnection.get_phix_error_rate
+
+
+@pytest.fixture
+def flowcells(monkeypatch):
+    flowcells = _Flowcells()
+    monkeypatch.setattr(cli._Connections, "get", lambda self, dbname: flowcells)
+    return flowcells
+
+
+def _query(lines, **kw):
+    out = io.StringIO()
+    failed = cli.query(io.StringIO("".join(line + "\n" for line in lines)), out, **kw)
+    return failed, [json.loads(line) for line in out.getvalue().splitlines()]
+
+
+def test_results_are_written_as_they_complete(flowcells):
+    failed, results = _query(['"slow"', '"fast"'], db="flowcells", method="get_entry", jobs=2)
+    assert failed == 0
+    assert [(r["id"], r["result"]["name"]) for r in results] == [(2, "fast"), (1, "slow")]
+
+
+def test_errors_are_answered_per_request(flowcells):
+    failed, results = _query(['{"id": "a", "db": "flowcells", "method": "get_entry", "args": ["missing"]}',
+                              '{"id": "b", "db": "flowcells", "method": "set_storage_status", "args": ["x", "y"]}',
+                              'not json',
+                              '',
+                              '{"id": "c", "db": "flowcells", "method": "get_phix_error_rate", "args": ["x", 1]}'],
+                             jobs=1)
+    assert failed == 3
+    results = {r["id"]: r for r in results}
+    assert results["a"]["error"] == "KeyError: 'missing'"
+    assert results["b"]["error"].startswith("ValueError: Unsupported method 'set_storage_status'")
+    assert results[3]["error"].startswith("Invalid request")
+    assert results["c"] == {"id": "c", "result": 0.5}
+
+
+@pytest.mark.parametrize("lines,status", [(['"fast"'], 0), (['"missing"', '"fast"'], 1)])
+def test_exit_status(flowcells, monkeypatch, lines, status):
+    monkeypatch.setattr("sys.stdin", io.StringIO("".join(line + "\n" for line in lines)))
+    monkeypatch.setattr("sys.stdout", io.StringIO())
+    assert cli.main(["query", "--db", "flowcells", "--method", "get_entry"]) == status
@@ -0,0 +1,72 @@
+"""Views of the statusdb design document against the ones they are built from"""
+import json
+import logging
+import shutil
+import subprocess
+import pytest
+from couchdb.http import ResourceNotFound
+from statusdb.db import design
+from statusdb.db.connections import FlowcellRunMetricsConnection
+
+INFO_MAP = ("function(doc) {\n"
+            "  if (doc.RunInfo && doc.storage_status) {\n"
+            "    emit(doc.RunInfo.Id, {\"storage_status\": doc.storage_status, \"instrument\": doc.RunInfo.Instrument});\n"
+            "  }\n"
+            "}")
+
+DOCS = [
+    {"RunInfo": {"Id": "190101_A00001_0001_AH0000XXXX", "Instrument": "A00001"}, "storage_status": "On server"},
+    {"RunInfo": {"Id": "190102_A00001_0002_AH0001XXXX", "Instrument": "A00001"}, "storage_status": "Archived"},
+    {"RunInfo": {"Id": "190103_M00001_0003_000000000-AAAAA"}, "storage_status": "On server"},
+    {"name": "190104_A00001_0004_AH0002XXXX"},
+]
+
+
+class _Row(dict):
+    def __getattr__(self, name):
+        return self[name]
+
+
+class _Database(dict):
+    """Documents, running the javascript views on node"""
+    name = "flowcells"
+
+    def save(self, doc):
+        self[doc["_id"]] = doc
+
+    def view(self, viewname, key=None, **options):
+        ddoc, view = viewname.split("/")
+        if "_design/" + ddoc not in self:
+            raise ResourceNotFound(("not_found", "missing"))
+        map_fn = self["_design/" + ddoc]["views"][view]["map"]
+        script = ("var rows = []; function emit(k, v) { rows.push([k, v]); }\n"
+                  "var map = (" + map_fn + ");\n" +
+                  json.dumps(DOCS) + ".forEach(function(doc) { map(doc); });\n"
+                  "console.log(JSON.stringify(rows));")
+        rows = json.loads(subprocess.check_output(["node", "-e", script]).decode("utf-8"))
+        return [_Row(key=k, value=v) for k, v in rows if key is None or k == key]
+
+
+def _connection(db):
+    con = FlowcellRunMetricsConnection.__new__(FlowcellRunMetricsConnection)
+    con.db = db
+    con.mirror = None
+    con.log = logging.getLogger(__name__)
+    return con
+
+
+@pytest.mark.skipif(shutil.which("node") is None, reason="needs node to run the views")
+def test_storage_status_view_matches_info_view():
+    db = _Database({"_design/info": {"views": {"storage_status": {"map": INFO_MAP}}}})
+    fallback = {status: _connection(db).get_storage_status(status) for status in ("On server", "Archived", "Gone")}
+    assert design.ensure_design_doc(db, "flowcells")
+    assert not design.ensure_design_doc(db, "flowcells")
+    viewed = {status: _connection(db).get_storage_status(status) for status in ("On server", "Archived", "Gone")}
+    assert viewed == fallback
+    assert sorted(viewed["On server"]) == ["190101_A00001_0001_AH0000XXXX", "190103_M00001_0003_000000000-AAAAA"]
+
+
+def test_storage_status_view_needs_info_view():
+    db = _Database()
+    assert design.ensure_design_doc(db, "flowcells")
+    assert db[design.DESIGN_ID]["views"] == {}
@@ -0,0 +1,75 @@
+"""Chunk files of database exports"""
+import glob
+import gzip
+import json
+import os
+import pytest
+from statusdb.db.export import Exporter, _ParquetChunkWriter
+
+
+class _Row(dict):
+    def __getattr__(self, name):
+        return self[name]
+
+
+class _Database(object):
+    """_all_docs of sorted documents, failing the view call numbered fail_at"""
+    name = "samples"
+
+    def __init__(self, docs, fail_at=None):
+        self.docs = sorted(docs, key=lambda doc: doc["_id"])
+        self.fail_at = fail_at
+        self.calls = 0
+
+    def view(self, viewname, startkey=None, endkey=None, limit=None, skip=0, include_docs=False):
+        self.calls += 1
+        if self.calls == self.fail_at:
+            raise IOError("connection reset")
+        rows = [_Row(id=doc["_id"], key=doc["_id"], doc=doc if include_docs else None) for doc in self.docs
+                if (startkey is None or doc["_id"] >= startkey) and (endkey is None or doc["_id"] <= endkey)]
+        rows = rows[skip:]
+        return rows[:limit] if limit else rows
+
+
+def _exported(outdir):
+    ids = []
+    for path in sorted(glob.glob(os.path.join(outdir, "*.ndjson.gz"))):
+        with gzip.open(path, "rt") as fh:
+            ids.extend(json.loads(line)["_id"] for line in fh)
+    return ids
+
+
+def test_interrupted_export_resumes_from_checkpoints(tmp_path):
+    docs = [{"_id": "doc{:03d}".format(i), "value": i} for i in range(96)] + [{"_id": "_design/names"}]
+    outdir = str(tmp_path)
+    db = _Database(docs, fail_at=5)
+    exporter = Exporter(db, outdir, partitions=3, workers=1, batch_size=10, chunk_size=20)
+    # Partition 0 fails in its fourth batch, with one chunk written
+    with pytest.raises(IOError):
+        exporter.run()
+    with open(os.path.join(outdir, "part-00000.ckpt")) as fh:
+        assert json.load(fh) == {"last_key": "doc019", "chunks": 1, "count": 20, "done": False}
+
+    db.fail_at, db.calls = None, 0
+    counts = Exporter(db, outdir, partitions=5, workers=2, batch_size=10, chunk_size=20).run()
+    # Partitions come from the manifest, and only partition 0 is read again
+    assert counts == {0: 32, 1: 32, 2: 32}
+    assert db.calls == 2
+    assert _exported(outdir) == [doc["_id"] for doc in docs[:-1]]
+    assert sorted(os.path.basename(p) for p in glob.glob(os.path.join(outdir, "part-00000-*"))) == [
+        "part-00000-00000.ndjson.gz", "part-00000-00001.ndjson.gz"]
+
+
+def test_parquet_chunk_is_written_in_row_groups(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    writer = _ParquetChunkWriter(str(tmp_path / "part"), row_group_size=3)
+    for i in range(7):
+        writer.write({"_id": str(i), "lanes": [i]} if i % 2 else {"_id": str(i), "name": "FC{}".format(i)})
+    writer.close()
+    parquet = pq.ParquetFile(writer.path)
+    assert parquet.metadata.num_row_groups == 3
+    rows = parquet.read().to_pylist()
+    assert rows[0] == {"_id": "0", "lanes": None, "name": "FC0"}
+    assert rows[1] == {"_id": "1", "lanes": "[1]", "name": None}
+    assert len(rows) == 7
+    assert [p.name for p in tmp_path.iterdir()] == ["part.parquet"]
@@ -0,0 +1,14 @@
+"""Flowcell summaries computed from fetched documents"""
+import pytest
+from statusdb.db.connections import _phix_error_rates
+
+
+def test_values_that_are_not_numbers_are_skipped():
+    fc = {"illumina": {
+        "Summary": {"R1": {"ReadType": "", "1": {"ErrRatePhiX": "0.5"}, "2": {"ErrRatePhiX": "n/a"},
+                           "3": {"ErrRatePhiX": "0"}, "5": {"ErrRatePhiX": "n/a"}},
+                    "R2": {"ReadType": "", "5": {"ErrRatePhiX": "0.7"}}},
+        "run_summary": {"3": {"% Error Rate R1": "0.3", "% Error Rate R2": None},
+                        "4": {"% Error Rate R1": "0.2", "% Error Rate R2": "0.4"}},
+    }}
+    assert _phix_error_rates(fc) == {"1": 0.5, "2": -1, "3": 0.3, "4": pytest.approx(0.3), "5": 0.7}
@@ -0,0 +1,78 @@
+"""Bulk ingestion of sample run metrics documents against a stub database"""
+from statusdb.db.connections import SampleRunMetricsDocument
+from statusdb.db.ingest import ingest_sample_run_metrics
+
+
+def _record(lane, sequence, **kw):
+    kw.update(lane=lane, date="190101", flowcell="AH0000XXXX", sequence=sequence)
+    return kw
+
+
+def _name(record):
+    return "{lane}_{date}_{flowcell}_{sequence}".format(**record)
+
+
+class _Database(object):
+    """Saves documents like couchdb.Database.update, writing _id and _rev
+    back into them, and fails the ones named in fail"""
+
+    def __init__(self, docs, fail=()):
+        self.docs = {doc["_id"]: doc for doc in docs}
+        self.fail = set(fail)
+
+    def update(self, docs):
+        results = []
+        for doc in docs:
+            if doc["name"] in self.fail:
+                results.append((False, doc["_id"], Exception("conflict")))
+                continue
+            doc["_rev"] = "2-b" if "_rev" in doc else "1-a"
+            self.docs[doc["_id"]] = dict(doc)
+            results.append((True, doc["_id"], doc["_rev"]))
+        return results
+
+
+class _Connection(object):
+    def __init__(self, db, broken=False):
+        self.db = db
+        self.broken = broken
+
+    def _view_lookup_many(self, view_name, keys, **kw):
+        if self.broken:
+            raise IOError("server went away")
+        names = {doc["name"]: doc["_id"] for doc in self.db.docs.values()}
+        return {key: names.get(key) for key in keys}
+
+    def _get_docs(self, doc_ids, **kw):
+        return {doc_id: dict(self.db.docs[doc_id]) for doc_id in doc_ids}
+
+
+def _existing(record):
+    doc = dict(SampleRunMetricsDocument(**record))
+    doc["_rev"] = "1-a"
+    return doc
+
+
+def test_counts_and_progress():
+    same, changed = _record("1", "ACGT"), _record("2", "ACGT", sample_prj="A")
+    db = _Database([_existing(same), _existing(changed)], fail=[_name(_record("3", "TTTT"))])
+    records = [same, _record("2", "ACGT", sample_prj="B"), _record("3", "ACGT"), _record("3", "GGGG"),
+               _record("3", "GGGG", sample_prj="C"), _record("3", "TTTT"), {"lane": "4"}]
+    progress = []
+    stats = ingest_sample_run_metrics(_Connection(db), records, processes=1, writers=1, batch_size=2,
+                                      progress=lambda s: progress.append(s.written))
+    assert (stats.built, stats.invalid, stats.duplicates) == (6, 1, 1)
+    assert (stats.created, stats.updated, stats.unchanged, stats.failed) == (2, 1, 1, 1)
+    assert progress == [2, 4, 5]
+    assert list(stats.errors) == [6, _name(_record("3", "TTTT"))]
+    assert len(db.docs) == 4
+    assert [doc["sample_prj"] for doc in db.docs.values() if doc["name"] == _name(_record("3", "GGGG"))] == ["C"]
+
+
+def test_failed_batch_counts_every_document():
+    db = _Database([])
+    stats = ingest_sample_run_metrics(_Connection(db, broken=True), [_record("1", "ACGT"), _record("2", "ACGT")],
+                                      processes=1, writers=1, progress=lambda s: None)
+    assert (stats.created, stats.failed) == (0, 2)
+    assert stats.errors == {_name(_record("1", "ACGT")): "server went away",
+                            _name(_record("2", "ACGT")): "server went away"}
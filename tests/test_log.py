@@ -0,0 +1,21 @@
+"""Sampling of per-document log messages"""
+import logging
+from statusdb.tools.log import SamplingFilter, PER_DOCUMENT
+
+
+def _record(level, per_document=True):
+    record = logging.LogRecord("statusdb", level, __file__, 1, "document %s", ("a",), None)
+    if per_document:
+        record.__dict__.update(PER_DOCUMENT)
+    return record
+
+
+def test_samples_per_document_info():
+    sampler = SamplingFilter(every=3)
+    assert [sampler.filter(_record(logging.INFO)) for _ in range(6)] == [True, False, False, True, False, False]
+    assert all(sampler.filter(_record(logging.INFO, per_document=False)) for _ in range(6))
+
+
+def test_never_samples_warnings_and_errors():
+    sampler = SamplingFilter(every=3)
+    assert all(sampler.filter(_record(level)) for level in [logging.WARNING, logging.ERROR] * 3)
@@ -0,0 +1,58 @@
+"""Materialized project reports against stub connections"""
+from statusdb.db.report import ReportMaterializer, SAMPLE_PRJ_INDEX
+
+
+class _Connection(object):
+    """Documents of one database, with the lookups the materializer uses"""
+
+    def __init__(self, docs):
+        self.docs = {doc["_id"]: doc for doc in docs}
+        self.db = "stub"
+        self.indexed = 0
+        self.queries = []
+
+    def _view_lookup(self, view_name, key):
+        return next((i for i, doc in self.docs.items() if doc.get("project_name") == key), None)
+
+    def _get_revs(self, doc_ids):
+        return {i: self.docs[i]["_rev"] for i in doc_ids if i in self.docs}
+
+    def _get_docs(self, doc_ids, **kw):
+        return {i: dict(self.docs[i]) for i in doc_ids}
+
+    def ensure_indexes(self):
+        self.indexed += 1
+        return []
+
+    def find_all(self, selector, fields=None, use_index=None):
+        self.queries.append(use_index)
+        return [{"_id": i} for i, doc in self.docs.items() if doc.get("sample_prj") == selector["sample_prj"]]
+
+
+def _sample(doc_id, barcode_name):
+    return {"_id": doc_id, "_rev": "1-a", "name": "1_190101_AH0000XXXX_" + doc_id, "sample_prj": "J.Doe_19_01",
+            "barcode_name": barcode_name, "lane": "1"}
+
+
+def _materializer():
+    p_con = _Connection([{"_id": "p", "_rev": "1-a", "project_name": "J.Doe_19_01", "application": "WG re-seq",
+                          "samples": {"P1234_101": {"scilife_name": "P1234_101", "customer_name": "s1"}}}])
+    s_con = _Connection([_sample("a", "P1234_101_index1"), _sample("b", "lib7_index1")])
+    return ReportMaterializer(p_con, s_con)
+
+
+def test_unmatched_sample_run_keeps_its_row():
+    report = _materializer().materialize("J.Doe_19_01")
+    rows = report["samples"]
+    assert rows["1_190101_AH0000XXXX_a"]["customer_name"] == "s1"
+    assert rows["1_190101_AH0000XXXX_b"]["scilife_name"] == "lib7_index1"
+    assert rows["1_190101_AH0000XXXX_b"]["customer_name"] is None
+    assert rows["1_190101_AH0000XXXX_b"]["sample"] == "lib7_index1"
+
+
+def test_membership_uses_the_sample_prj_index():
+    materializer = _materializer()
+    materializer.materialize("J.Doe_19_01")
+    materializer.materialize("J.Doe_19_01")
+    assert materializer.s_con.indexed == 1
+    assert materializer.s_con.queries == [SAMPLE_PRJ_INDEX, SAMPLE_PRJ_INDEX]
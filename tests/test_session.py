@@ -0,0 +1,238 @@
+"""Request policy of StatusdbSession against a fault injecting server"""
+import socket
+import threading
+import time
+import pytest
+from couchdb import http
+from couchdb.http import ServerError
+from statusdb.db.policy import RequestPolicy, CircuitOpenError
+from statusdb.db.session import StatusdbSession, use_json_codec
+
+
+def _get(session, url):
+    status, _, data = session.request("GET", url)
+    if hasattr(data, "read"):
+        data.read()
+        data.close()
+    return status
+
+
+def _session(**policy):
+    policy.setdefault("backoff", 0.01)
+    return StatusdbSession(policy=RequestPolicy(**policy))
+
+
+def test_retries_transient_errors(fault_server):
+    session = _session()
+    fault_server.inject({"status": 503}, {"status": 504})
+    assert _get(session, fault_server.url + "/db/doc") == 200
+    assert len(fault_server.requests) == 3
+    assert session.stats.retries == 2
+
+
+def test_retries_dropped_connections(fault_server):
+    session = _session()
+    fault_server.inject({"drop": True}, {"drop": True}, {"drop": True})
+    assert _get(session, fault_server.url + "/db/doc") == 200
+    assert len(fault_server.requests) == 4
+
+
+def test_gives_up_after_retries(fault_server):
+    session = _session(retries=2)
+    fault_server.inject(*[{"status": 503}] * 3)
+    with pytest.raises(ServerError):
+        _get(session, fault_server.url + "/db/doc")
+    assert len(fault_server.requests) == 3
+
+
+def test_does_not_retry_writes(fault_server):
+    session = _session()
+    fault_server.inject({"status": 503})
+    with pytest.raises(ServerError):
+        session.request("POST", fault_server.url + "/db/_bulk_docs", body={"docs": []})
+    assert len(fault_server.requests) == 1
+
+
+def test_retries_read_posts(fault_server):
+    session = _session()
+    fault_server.inject({"status": 502})
+    status, _, data = session.request("POST", fault_server.url + "/db/_all_docs", body={"keys": []})
+    assert status == 200
+    assert len(fault_server.requests) == 2
+
+
+def test_circuit_breaker_opens_and_recovers(fault_server):
+    session = _session(retries=0, breaker_threshold=2, breaker_reset=0.2)
+    fault_server.inject({"status": 500}, {"status": 500})
+    for _ in range(2):
+        with pytest.raises(ServerError):
+            _get(session, fault_server.url + "/db/doc")
+    with pytest.raises(CircuitOpenError):
+        _get(session, fault_server.url + "/db/doc")
+    assert len(fault_server.requests) == 2
+    time.sleep(0.25)
+    assert _get(session, fault_server.url + "/db/doc") == 200
+    assert _get(session, fault_server.url + "/db/doc") == 200
+
+
+def test_client_errors_do_not_open_breaker(fault_server):
+    session = _session(retries=0, breaker_threshold=1)
+    fault_server.inject({"status": 400})
+    with pytest.raises(ServerError):
+        _get(session, fault_server.url + "/db/doc")
+    assert _get(session, fault_server.url + "/db/doc") == 200
+
+
+def test_read_timeout(fault_server):
+    session = _session(retries=0, read_timeout=0.2)
+    fault_server.inject({"delay": 2})
+    start = time.time()
+    with pytest.raises(socket.timeout):
+        _get(session, fault_server.url + "/db/doc")
+    assert time.time() - start < 1
+
+
+def test_connect_timeout_covers_tls_handshake(stall_server):
+    session = _session(retries=0, read_timeout=0.3)
+    errors = []
+
+    def request():
+        try:
+            _get(session, stall_server.url + "/db/doc")
+        except Exception as e:
+            errors.append(e)
+    thread = threading.Thread(target=request)
+    thread.daemon = True
+    thread.start()
+    thread.join(5)
+    assert not thread.is_alive(), "TLS handshake with a stalled server did not time out"
+    assert isinstance(errors[0], socket.timeout)
+
+
+def test_hedges_slow_read(fault_server):
+    session = _session(hedge_after=0.1)
+    fault_server.inject({"delay": 1.5})
+    start = time.time()
+    assert _get(session, fault_server.url + "/db/doc") == 200
+    assert time.time() - start < 1
+    assert session.stats.hedged == 1
+
+
+def test_concurrent_reads_are_not_hedged_for_queueing(fault_server):
+    fault_server.latency = 0.3
+    session = _session(hedge_after=1.0)
+    threads = [threading.Thread(target=_get, args=(session, fault_server.url + "/db/doc{}".format(i)))
+               for i in range(32)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert session.stats.hedged == 0
+    assert time.time() - start < 1
+
+
+def test_concurrent_identical_reads_share_one_request(fault_server):
+    fault_server.latency = 0.3
+    session = _session()
+    bodies = []
+
+    def read():
+        _, _, data = session.request("GET", fault_server.url + "/db/doc")
+        bodies.append(data)
+    threads = [threading.Thread(target=read) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(fault_server.requests) == 1
+    assert session.stats.coalesced == 7
+    # Every caller reads a body of its own
+    assert len(set(id(body) for body in bodies)) == 8
+    assert all(body.read() == b'{"ok": true}' for body in bodies)
+
+
+def test_concurrent_writes_are_not_shared(fault_server):
+    fault_server.latency = 0.3
+    session = _session()
+    threads = [threading.Thread(target=session.request, args=("PUT", fault_server.url + "/db/doc"),
+                                kwargs={"body": {"a": 1}}) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(fault_server.requests) == 4
+    assert session.stats.coalesced == 0
+
+
+@pytest.fixture
+def json_codec():
+    """Restore the process wide codec of couchdb changed by use_json_codec"""
+    from couchdb import json as couch_json
+    saved = couch_json._using, couch_json._initialized, couch_json._decode, couch_json._encode
+    yield use_json_codec
+    couch_json._using, couch_json._initialized, couch_json._decode, couch_json._encode = saved
+
+
+def test_decoding_is_timed(fault_server, json_codec):
+    json_codec("json")
+    session = _session()
+    _, _, data = http.Resource(fault_server.url, session).get_json("db/doc")
+    assert data == {"ok": True}
+    assert session.stats.decodes == 1
+    assert session.stats.decode_seconds > 0
+
+
+def _large_body():
+    # Large enough, also compressed, for couchdb to stream the response
+    return {"rows": [{"id": "doc{}".format(i), "value": i * 7919 % 104729} for i in range(5000)]}
+
+
+@pytest.mark.parametrize("chunked", [False, True])
+def test_reads_gzip_responses(fault_server, chunked):
+    from couchdb import json as couch_json
+    # Not shared, which would read the whole body at once
+    session = StatusdbSession(policy=RequestPolicy(backoff=0.01), single_flight=False)
+    body = _large_body()
+    fault_server.inject({"gzip": True, "chunked": chunked, "body": body})
+    _, _, data = session.request("GET", fault_server.url + "/db/_all_docs")
+    assert fault_server.headers[0]["Accept-Encoding"] == "gzip"
+    # Streamed from the connection, not buffered by couchdb
+    assert isinstance(data, http.ResponseBody)
+    parts = []
+    while True:
+        part = data.read(1000)
+        parts.append(part)
+        if len(part) < 1000:
+            break
+    decoded = b"".join(parts)
+    assert couch_json.decode(decoded.decode("utf-8")) == body
+    assert session.stats.bytes_decoded == len(decoded)
+    assert session.stats.bytes_received < len(decoded)
+
+
+def test_feeds_are_not_asked_for_gzip(fault_server):
+    session = _session()
+    _get(session, fault_server.url + "/db/_changes?feed=continuous")
+    assert "Accept-Encoding" not in fault_server.headers[0]
+
+
+class _Interrupted(BaseException):
+    pass
+
+
+@pytest.mark.parametrize("error", [http.RedirectLimit("Redirection limit exceeded"), _Interrupted()])
+def test_trial_failing_on_the_client_does_not_keep_breaker_open(fault_server, monkeypatch, error):
+    session = _session(retries=0, breaker_threshold=1, breaker_reset=0.1)
+    fault_server.inject({"status": 500})
+    with pytest.raises(ServerError):
+        _get(session, fault_server.url + "/db/doc")
+    time.sleep(0.15)
+
+    def fail(*args, **kwargs):
+        raise error
+    with monkeypatch.context() as m:
+        m.setattr(http.Session, "request", fail)
+        with pytest.raises(type(error)):
+            _get(session, fault_server.url + "/db/doc")
+    assert _get(session, fault_server.url + "/db/doc") == 200
@@ -0,0 +1,158 @@
+"""Saving documents through the patch update handler"""
+import copy
+import itertools
+import logging
+import pytest
+from couchdb.http import ResourceConflict, ResourceNotFound
+from statusdb.db import Couch, design, utils
+from statusdb.db.connections import FlowcellRunMetricsConnection, update_fn
+from statusdb.db.policy import RequestPolicy
+
+
+class _Row(dict):
+    def __getattr__(self, name):
+        return self[name]
+
+
+class _Resource(object):
+    _ids = itertools.count()
+
+    def __init__(self, db):
+        self.db = db
+        # Unique, as databases without the handler are remembered by url
+        self.url = "http://localhost/db{}".format(next(self._ids))
+
+    def post_json(self, path, body=None):
+        return self.db.patch(path[-1], body)
+
+
+class _Database(object):
+    """In-memory database with the patch update handler installed"""
+
+    def __init__(self, docs):
+        self.docs = {doc["_id"]: dict(doc) for doc in docs}
+        self.resource = _Resource(self)
+        self.saves = 0
+        self.patches = 0
+        self.fail_patch = None
+
+    def get(self, doc_id, default=None):
+        doc = self.docs.get(doc_id)
+        return copy.deepcopy(doc) if doc else default
+
+    def view(self, viewname, keys=None, **options):
+        if viewname == "_all_docs":
+            return [_Row(key=k, doc=self.get(k)) for k in keys]
+        return [_Row(key=doc["_id"], id=doc["_id"], value=doc["name"]) for doc in self.docs.values()]
+
+    def update(self, docs):
+        results = []
+        for doc in docs:
+            try:
+                self.save(doc)
+                results.append((True, doc["_id"], doc["_rev"]))
+            except ResourceConflict as e:
+                results.append((False, doc["_id"], e))
+        return results
+
+    def save(self, doc):
+        self.saves += 1
+        current = self.docs.get(doc["_id"])
+        if (current or {}).get("_rev") != doc.get("_rev"):
+            raise ResourceConflict(("conflict", "Document update conflict."))
+        doc["_rev"] = "{}-x".format(int((current or {"_rev": "0"})["_rev"].split("-")[0]) + 1)
+        self.docs[doc["_id"]] = copy.deepcopy(doc)
+
+    def patch(self, doc_id, patch):
+        self.patches += 1
+        if self.fail_patch:
+            raise self.fail_patch.pop(0)
+        current = self.docs[doc_id]
+        if patch["_rev"] != current["_rev"]:
+            raise ResourceConflict(("conflict", "Document update conflict."))
+        for path, value in patch["set"]:
+            current[path[-1]] = value
+        current["_rev"] = "{}-x".format(int(current["_rev"].split("-")[0]) + 1)
+        return 201, {"X-Couch-Update-NewRev": current["_rev"]}, {"ok": True}
+
+
+def test_patch_conflict_is_retried_with_a_fresh_read():
+    db = _Database([{"_id": "a", "_rev": "1-x", "creation_time": "t", "value": 1}])
+    stale = db.get("a")
+    db.docs["a"].update(_rev="2-x", other=2)
+    obj = {"_id": "a", "value": 3, "other": 2}
+    assert utils.save_couchdb_obj(db, obj, base=stale) == 'uppdated'
+    # The stale patch conflicts, and is not followed by a whole document save
+    assert db.saves == 0
+    assert db.patches == 2
+    assert db.docs["a"]["value"] == 3
+    assert db.docs["a"]["other"] == 2
+
+
+def test_deleted_document_does_not_disable_patching():
+    db = _Database([{"_id": "a", "_rev": "1-x", "creation_time": "t", "value": 1}])
+    stale = db.get("a")
+    del db.docs["a"]
+    db.fail_patch = [ResourceNotFound((design.PATCH_NOT_FOUND, "missing"))]
+    assert utils.save_couchdb_obj(db, {"_id": "a", "value": 3}, base=stale) == 'created'
+    assert db.resource.url not in utils._NO_PATCH_HANDLER
+
+
+def test_missing_handler_falls_back_to_whole_saves():
+    db = _Database([{"_id": "a", "_rev": "1-x", "creation_time": "t", "value": 1}])
+    db.fail_patch = [ResourceNotFound(("not_found", "missing"))]
+    assert utils.save_couchdb_obj(db, {"_id": "a", "value": 3}) == 'uppdated'
+    assert db.saves == 1
+    assert db.resource.url in utils._NO_PATCH_HANDLER
+    utils.save_couchdb_obj(db, {"_id": "a", "value": 4})
+    assert db.patches == 1
+
+
+class _Connection(Couch):
+    _update_fn = update_fn
+
+    def __init__(self, db):
+        self.db = db
+        self.mirror = None
+        self.policy = RequestPolicy()
+        self.log = logging.getLogger(__name__)
+
+
+class _Flowcells(FlowcellRunMetricsConnection):
+    def __init__(self, db):
+        self.db = db
+        self.mirror = None
+        self.log = logging.getLogger(__name__)
+
+
+def _run(doc_id, status="On server"):
+    return {"_id": doc_id, "_rev": "1-x", "name": doc_id, "creation_time": "t", "storage_status": status}
+
+
+def test_save_patches_changed_documents():
+    db = _Database([{"_id": "a", "_rev": "1-x", "name": "FC1", "creation_time": "t", "value": 1}])
+    obj = {"_id": "new-uuid", "name": "FC1", "value": 2}
+    _Connection(db).save(obj)
+    assert (db.patches, db.saves) == (1, 0)
+    assert db.docs["a"]["value"] == 2
+    assert obj["_id"] == "a" and obj["_rev"] == "2-x"
+    _Connection(db).save({"_id": "other-uuid", "name": "FC1", "value": 2})
+    assert (db.patches, db.saves) == (1, 0)
+    _Connection(db).save({"_id": "b", "name": "FC2", "value": 1})
+    assert (db.patches, db.saves) == (1, 1)
+
+
+def test_storage_status_is_patched():
+    db = _Database([_run("a"), _run("b", "Archived"), _run("c")])
+    results = _Flowcells(db).set_storage_status_many(["a", "b", "c", "d"], "Archived")
+    assert results == {"a": "updated", "b": "not updated", "c": "updated", "d": "not found"}
+    assert (db.patches, db.saves) == (2, 0)
+    assert db.docs["c"]["storage_status"] == "Archived"
+
+
+def test_storage_status_without_handler_is_saved_whole():
+    db = _Database([_run("a")])
+    db.fail_patch = [ResourceNotFound(("not_found", "missing"))]
+    results = _Flowcells(db).set_storage_status_many(["a"], "Archived")
+    assert results == {"a": "updated"}
+    assert (db.patches, db.saves) == (1, 1)
@@ -0,0 +1,55 @@
+"""Lazily loaded views and key lookups"""
+from statusdb.db import Couch, lazy_view
+
+
+class _Row(dict):
+    def __getattr__(self, name):
+        return self[name]
+
+
+class _Database(object):
+    name = "flowcells"
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = []
+
+    def view(self, viewname, keys=None, **options):
+        self.queries.append(keys)
+        return [_Row(key=k, id=i, value=None) for k, i in self.rows if keys is None or k in keys]
+
+
+class _Connection(Couch):
+    name_view = lazy_view("names/name", "id", reduce=False)
+
+    def __init__(self, db):
+        self.db = db
+        self.mirror = None
+
+
+def test_view_is_loaded_on_first_access_only():
+    con = _Connection(_Database([("FC1", "a")]))
+    assert con.db.queries == []
+    assert con.name_view == {"FC1": "a"}
+    con.name_view
+    assert con.db.queries == [None]
+
+
+def test_key_lookup_matches_loaded_view_for_duplicate_keys():
+    rows = [("FC1", "a"), ("FC1", "b"), ("FC2", "c")]
+    con = _Connection(_Database(rows))
+    looked_up = con._view_lookup_many("name_view", ["FC1", "FC2", "FC3"])
+    assert con.db.queries == [["FC1", "FC2", "FC3"]]
+    assert looked_up == {"FC1": "b", "FC2": "c", "FC3": None}
+    loaded = _Connection(_Database(rows))
+    loaded.name_view
+    assert loaded._view_lookup_many("name_view", ["FC1", "FC2", "FC3"]) == looked_up
+
+
+def test_writes_do_not_look_up_in_a_loaded_view():
+    con = _Connection(_Database([("FC1", "a")]))
+    con.name_view
+    con.db.rows.append(("FC2", "b"))
+    assert con._view_lookup_many("name_view", ["FC2"]) == {"FC2": None}
+    assert con._view_lookup_many("name_view", ["FC2"], use_mirror=False, use_loaded=False) == {"FC2": "b"}
+    assert con.db.queries == [None, ["FC2"]]